@@ -28,6 +28,10 @@
 #include <limits.h> // for CHAR_MAX
 #include <getopt.h>
 
+#include <sstream>
+
+#include "md5.h"
+
 #include "pickle.hpp"
 
 #include "os_binary.hpp"
@@ -48,11 +52,13 @@ class PickleVisitor : public trace::Visitor
 protected:
     PickleWriter &writer;
     bool symbolic;
+    bool blobDigests;
 
 public:
-    PickleVisitor(PickleWriter &_writer, bool _symbolic) :
+    PickleVisitor(PickleWriter &_writer, bool _symbolic, bool _blobDigests) :
         writer(_writer),
-        symbolic(_symbolic) {
+        symbolic(_symbolic),
+        blobDigests(_blobDigests) {
     }
 
     void visit(Null *node) {
@@ -152,7 +158,16 @@ public:
     }
 
     void visit(Blob *node) {
-        writer.writeByteArray(node->buf, node->size);
+        if (blobDigests) {
+            struct MD5Context md5c;
+            unsigned char digest[16];
+            MD5Init(&md5c);
+            MD5Update(&md5c, (unsigned char *)node->buf, node->size);
+            MD5Final(digest, &md5c);
+            writer.writeBlob(node->size, digest, sizeof digest);
+        } else {
+            writer.writeByteArray(node->buf, node->size);
+        }
     }
 
     void visit(Pointer *node) {
@@ -204,6 +219,40 @@ public:
 };
 
 
+/*
+ * The chunked format is a magic header followed by length-prefixed records,
+ * each record holding a pickled list of call tuples.  This allows readers to
+ * decode many calls with a single read, instead of one pickle per call.  See
+ * scripts/unpickle.py.
+ */
+static const char chunkedMagic[4] = {'A', 'T', 'P', 'K'};
+
+/* Flush chunks once they grow beyond this size */
+static const std::streamoff chunkSize = 1024*1024;
+
+
+static void
+writeChunk(std::ostringstream &chunk, PickleWriter &writer)
+{
+    writer.endList();
+    writer.end();
+
+    std::string s = chunk.str();
+    uint32_t length = s.size();
+    char prefix[4] = {
+        (char)( length        & 0xff),
+        (char)((length >>  8) & 0xff),
+        (char)((length >> 16) & 0xff),
+        (char)( length >> 24        ),
+    };
+    std::cout.write(prefix, sizeof prefix);
+    std::cout.write(s.data(), s.size());
+
+    chunk.str("");
+    chunk.clear();
+}
+
+
 static trace::CallSet calls(trace::FREQUENCY_ALL);
 
 static const char *synopsis = "Pickle given trace(s) to standard output.";
@@ -217,12 +266,17 @@ usage(void)
         "\n"
         "    -h, --help           show this help message and exit\n"
         "    -s, --symbolic       dump symbolic names\n"
+        "    --blob-digests       dump blobs as their size and MD5 digest\n"
         "    --calls=CALLSET      only dump specified calls\n"
+        "    --format=FORMAT      output format: pickle (one pickle per call, default)\n"
+        "                         or chunked (length-prefixed batches of calls)\n"
     ;
 }
 
 enum {
 	CALLS_OPT = CHAR_MAX + 1,
+	FORMAT_OPT,
+	BLOB_DIGESTS_OPT,
 };
 
 const static char *
@@ -233,6 +287,8 @@ longOptions[] = {
     {"help", no_argument, 0, 'h'},
     {"symbolic", no_argument, 0, 's'},
     {"calls", required_argument, 0, CALLS_OPT},
+    {"format", required_argument, 0, FORMAT_OPT},
+    {"blob-digests", no_argument, 0, BLOB_DIGESTS_OPT},
     {0, 0, 0, 0}
 };
 
@@ -240,6 +296,8 @@ static int
 command(int argc, char *argv[])
 {
     bool symbolic = false;
+    bool chunked = false;
+    bool blobDigests = false;
 
     int opt;
     while ((opt = getopt_long(argc, argv, shortOptions, longOptions, NULL)) != -1) {
@@ -253,6 +311,20 @@ command(int argc, char *argv[])
         case CALLS_OPT:
             calls.merge(optarg);
             break;
+        case BLOB_DIGESTS_OPT:
+            blobDigests = true;
+            break;
+        case FORMAT_OPT:
+            if (strcmp(optarg, "pickle") == 0) {
+                chunked = false;
+            } else if (strcmp(optarg, "chunked") == 0) {
+                chunked = true;
+            } else {
+                std::cerr << "error: unknown format `" << optarg << "`\n";
+                usage();
+                return 1;
+            }
+            break;
         default:
             std::cerr << "error: unexpected option `" << (char)opt << "`\n";
             usage();
@@ -264,8 +336,13 @@ command(int argc, char *argv[])
     
     std::cout.sync_with_stdio(false);
 
-    PickleWriter writer(std::cout);
-    PickleVisitor visitor(writer, symbolic);
+    std::ostringstream chunk;
+    PickleWriter writer(chunked ? chunk : std::cout);
+    PickleVisitor visitor(writer, symbolic, blobDigests);
+
+    if (chunked) {
+        std::cout.write(chunkedMagic, sizeof chunkedMagic);
+    }
 
     for (int i = optind; i < argc; ++i) {
         trace::Parser parser;
@@ -276,15 +353,37 @@ command(int argc, char *argv[])
 
         trace::Call *call;
         while ((call = parser.parse_call())) {
+            /* There's no use doing any work past the last call requested by
+             * the user. */
+            if (call->no > calls.getLast()) {
+                delete call;
+                break;
+            }
+
             if (calls.contains(*call)) {
-                writer.begin();
-                visitor.visit(call);
-                writer.end();
+                if (chunked) {
+                    if (chunk.tellp() == 0) {
+                        writer.begin();
+                        writer.beginList();
+                    }
+                    visitor.visit(call);
+                    if (chunk.tellp() >= chunkSize) {
+                        writeChunk(chunk, writer);
+                    }
+                } else {
+                    writer.begin();
+                    visitor.visit(call);
+                    writer.end();
+                }
             }
             delete call;
         }
     }
 
+    if (chunked && chunk.tellp() > 0) {
+        writeChunk(chunk, writer);
+    }
+
     return 0;
 }
 
@@ -324,6 +324,17 @@ public:
         os.put(REDUCE);
     }
 
+    inline void writeBlob(unsigned long long size, const void *digest, size_t digestSize) {
+        os.put(GLOBAL);
+        os << "unpickle\nBlob\n";
+        os.put(BINPUT);
+        os.put(1);
+        writeInt(size);
+        writeString(static_cast<const char *>(digest), digestSize);
+        os.put(TUPLE2);
+        os.put(REDUCE);
+    }
+
     inline void writePointer(unsigned long long addr) {
         os.put(GLOBAL);
         os << "unpickle\nPointer\n";
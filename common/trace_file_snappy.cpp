@@ -121,6 +121,8 @@ private:
 
     char *m_compressedCache;
 
+    // Whether the cache holds the uncompressed chunk at m_currentOffset.
+    bool m_cacheLoaded;
     File::Offset m_currentOffset;
     std::streampos m_endPos;
 };
@@ -131,7 +133,8 @@ SnappyFile::SnappyFile(const std::string &filename,
       m_cacheMaxSize(SNAPPY_CHUNK_SIZE),
       m_cacheSize(m_cacheMaxSize),
       m_cache(new char [m_cacheMaxSize]),
-      m_cachePtr(m_cache)
+      m_cachePtr(m_cache),
+      m_cacheLoaded(false)
 {
     size_t maxCompressedLength =
         snappy::MaxCompressedLength(SNAPPY_CHUNK_SIZE);
@@ -284,6 +287,7 @@ void SnappyFile::flushWriteCache()
 void SnappyFile::flushReadCache(size_t skipLength)
 {
     //assert(m_cachePtr == m_cache + m_cacheSize);
+    m_cacheLoaded = false;
     m_currentOffset.chunk = m_stream.tellg();
     size_t compressedLength;
     compressedLength = readCompressedLength();
@@ -307,6 +311,7 @@ void SnappyFile::flushReadCache(size_t skipLength)
     if (skipLength < m_cacheSize) {
         ::snappy::RawUncompress(m_compressedCache, compressedLength,
                                 m_cache);
+        m_cacheLoaded = true;
     }
 }
 
@@ -366,6 +371,13 @@ File::Offset SnappyFile::currentOffset()
 
 void SnappyFile::setCurrentOffset(const File::Offset &offset)
 {
+    if (m_cacheLoaded && offset.chunk == m_currentOffset.chunk) {
+        // the chunk is already loaded, so just move within it
+        assert(m_cacheSize >= offset.offsetInChunk);
+        m_cachePtr = m_cache + offset.offsetInChunk;
+        return;
+    }
+
     // to remove eof bit
     m_stream.clear();
     // seek to the start of a chunk
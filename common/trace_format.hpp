@@ -34,7 +34,7 @@
 namespace trace {
 
 
-#define TRACE_VERSION 5
+#define TRACE_VERSION 6
 
 
 enum Event {
@@ -67,6 +67,7 @@ enum Type {
     TYPE_OPAQUE,
     TYPE_REPR,
     TYPE_WSTRING,
+    TYPE_BLOB_REF,
 };
 
 enum BacktraceDetail {
@@ -40,12 +40,22 @@
 namespace trace {
 
 
+/**
+ * Bound for the data of referenced blobs kept in memory, when the trace file
+ * supports seeking back to read them again.
+ */
+static const size_t maxCachedBlobsSize = 64*1024*1024;
+
+
 Parser::Parser() {
     file = NULL;
+    blobFile = NULL;
     next_call_no = 0;
     version = 0;
     api = API_UNKNOWN;
 
+    cachedBlobsSize = 0;
+
     glGetErrorSig = NULL;
 }
 
@@ -70,6 +80,7 @@ bool Parser::open(const char *filename) {
         return false;
     }
     api = API_UNKNOWN;
+    this->filename = filename;
 
     return true;
 }
@@ -98,6 +109,11 @@ void Parser::close(void) {
         delete file;
         file = NULL;
     }
+    if (blobFile) {
+        blobFile->close();
+        delete blobFile;
+        blobFile = NULL;
+    }
 
     deleteAll(calls);
 
@@ -154,6 +170,17 @@ void Parser::close(void) {
     }
     bitmasks.clear();
 
+    for (BlobMap::iterator it = blobs.begin(); it != blobs.end(); ++it) {
+        BlobState *blob = *it;
+        if (blob) {
+            delete [] blob->data;
+            delete blob;
+        }
+    }
+    blobs.clear();
+    cachedBlobs.clear();
+    cachedBlobsSize = 0;
+
     next_call_no = 0;
 }
 
@@ -676,6 +703,9 @@ Value *Parser::parse_value(void) {
     case trace::TYPE_WSTRING:
         value = parse_wstring();
         break;
+    case trace::TYPE_BLOB_REF:
+        value = parse_blob_ref();
+        break;
     default:
         std::cerr << "error: unknown type " << c << "\n";
         exit(1);
@@ -740,6 +770,9 @@ void Parser::scan_value(void) {
     case trace::TYPE_WSTRING:
         scan_wstring();
         break;
+    case trace::TYPE_BLOB_REF:
+        scan_blob_ref();
+        break;
     default:
         std::cerr << "error: unknown type " << c << "\n";
         exit(1);
@@ -879,6 +912,135 @@ void Parser::scan_blob(void) {
 }
 
 
+/*
+ * Blobs referred to by ID are defined along with their first occurrence only.
+ * As with signatures, the offset tells whether a definition is to be expected
+ * when parsing again after seeking back.
+ */
+Value *Parser::parse_blob_ref(void) {
+    size_t id = read_uint();
+    BlobState *state = lookup(blobs, id);
+    Blob *blob;
+
+    if (!state || file->currentOffset() < state->fileOffset) {
+        size_t size = read_uint();
+        File::Offset dataOffset = file->currentOffset();
+        blob = new Blob(size);
+        file->read(blob->buf, size);
+        if (!state) {
+            state = define_blob(id, dataOffset, size);
+        }
+        cache_blob(state, blob->buf);
+    } else {
+        blob = new Blob(state->size);
+        if (state->data) {
+            memcpy(blob->buf, state->data, state->size);
+            cache_blob(state, state->data);
+        } else {
+            read_blob(state, blob->buf);
+            cache_blob(state, blob->buf);
+        }
+    }
+
+    return blob;
+}
+
+
+void Parser::scan_blob_ref(void) {
+    size_t id = read_uint();
+    BlobState *state = lookup(blobs, id);
+
+    if (!state || file->currentOffset() < state->fileOffset) {
+        size_t size = read_uint();
+        File::Offset dataOffset = file->currentOffset();
+        if (!state && !file->supportsOffsets()) {
+            std::vector<char> data(size);
+            if (size) {
+                file->read(&data[0], size);
+            }
+            state = define_blob(id, dataOffset, size);
+            cache_blob(state, size ? &data[0] : NULL);
+        } else {
+            if (size) {
+                file->skip(size);
+            }
+            if (!state) {
+                define_blob(id, dataOffset, size);
+            }
+        }
+    }
+}
+
+
+Parser::BlobState *
+Parser::define_blob(size_t id, const File::Offset &dataOffset, size_t size) {
+    BlobState *blob = new BlobState;
+    blob->size = size;
+    blob->dataOffset = dataOffset;
+    blob->fileOffset = file->currentOffset();
+    blob->data = NULL;
+    blobs[id] = blob;
+    return blob;
+}
+
+
+/**
+ * Keep the data of a blob in memory, for resolving references to it, or mark
+ * it as the most recently used if already kept.  Unless the file can't seek
+ * back to read it again, the least recently used blobs are evicted past
+ * maxCachedBlobsSize.
+ */
+void Parser::cache_blob(BlobState *blob, const char *data) {
+    if (blob->data) {
+        cachedBlobs.splice(cachedBlobs.end(), cachedBlobs, blob->cacheEntry);
+        return;
+    }
+
+    bool evict = file->supportsOffsets();
+    if (evict && blob->size > maxCachedBlobsSize) {
+        return;
+    }
+
+    blob->data = new char[blob->size];
+    if (blob->size) {
+        memcpy(blob->data, data, blob->size);
+    }
+    blob->cacheEntry = cachedBlobs.insert(cachedBlobs.end(), blob);
+    cachedBlobsSize += blob->size;
+
+    while (evict && cachedBlobsSize > maxCachedBlobsSize) {
+        BlobState *oldest = cachedBlobs.front();
+        cachedBlobs.pop_front();
+        cachedBlobsSize -= oldest->size;
+        delete [] oldest->data;
+        oldest->data = NULL;
+    }
+}
+
+
+
+/**
+ * Read the data of an evicted blob again from its definition.  This is done
+ * through blobFile, so that the chunk being parsed needn't be reloaded after
+ * each lookup, and so that blobs referred to in the order they were defined
+ * are read sequentially.
+ */
+void Parser::read_blob(BlobState *blob, char *data) {
+    if (!blobFile) {
+        blobFile = File::createForRead(filename.c_str());
+    }
+
+    if (blobFile) {
+        blobFile->setCurrentOffset(blob->dataOffset);
+        blobFile->read(data, blob->size);
+    } else {
+        File::Offset offset = file->currentOffset();
+        file->setCurrentOffset(blob->dataOffset);
+        file->read(data, blob->size);
+        file->setCurrentOffset(offset);
+    }
+}
+
 Value *Parser::parse_struct() {
     StructSig *sig = parse_struct_sig();
     Struct *value = new Struct(sig);
@@ -28,6 +28,7 @@
 
 #include <iostream>
 #include <list>
+#include <string>
 
 #include "trace_file.hpp"
 #include "trace_format.hpp"
@@ -50,6 +51,11 @@ class Parser
 protected:
     File *file;
 
+    // Name of the file, and a second handle on it for reading evicted blobs
+    // again without losing our place in file.
+    std::string filename;
+    File *blobFile;
+
     enum Mode {
         FULL = 0,
         SCAN,
@@ -91,6 +97,26 @@ protected:
     BitmaskMap bitmasks;
     StackFrameMap frames;
 
+    // Blobs that can be referred to by later blobs.
+    struct BlobState {
+        size_t size;
+        // Offset of the blob data, to read it again.
+        File::Offset dataOffset;
+        // Offset past the blob definition, as in SigState.
+        File::Offset fileOffset;
+        // Cached data, or NULL, and its position in cachedBlobs.
+        char *data;
+        std::list<BlobState *>::iterator cacheEntry;
+    };
+
+    typedef std::vector<BlobState *> BlobMap;
+    BlobMap blobs;
+
+    // Blobs with cached data, least recently used first, and the size of
+    // their data.
+    std::list<BlobState *> cachedBlobs;
+    size_t cachedBlobsSize;
+
     FunctionSig *glGetErrorSig;
 
     unsigned next_call_no;
@@ -196,6 +222,12 @@ protected:
     Value *parse_blob(void);
     void scan_blob(void);
 
+    Value *parse_blob_ref(void);
+    void scan_blob_ref(void);
+    BlobState *define_blob(size_t id, const File::Offset &dataOffset, size_t size);
+    void cache_blob(BlobState *blob, const char *data);
+    void read_blob(BlobState *blob, char *data);
+
     Value *parse_struct();
     void scan_struct();
 
@@ -26,6 +26,7 @@
 
 #include "trace_profiler.hpp"
 #include "os_time.hpp"
+#include <algorithm>
 #include <iostream>
 #include <string.h>
 #include <sstream>
@@ -40,7 +41,9 @@ Profiler::Profiler()
       cpuTimes(false),
       gpuTimes(true),
       pixelsDrawn(false),
-      memoryUsage(false)
+      memoryUsage(false),
+      binary(false),
+      numValues(0)
 {
 }
 
@@ -48,16 +51,98 @@ Profiler::~Profiler()
 {
 }
 
-void Profiler::setup(bool cpuTimes_, bool gpuTimes_, bool pixelsDrawn_, bool memoryUsage_)
+void Profiler::setup(bool cpuTimes_, bool gpuTimes_, bool pixelsDrawn_, bool memoryUsage_, bool binary_)
 {
     cpuTimes = cpuTimes_;
     gpuTimes = gpuTimes_;
     pixelsDrawn = pixelsDrawn_;
     memoryUsage = memoryUsage_;
+    binary = binary_;
+
+    if (binary) {
+        // Only the enabled values are written, as little-endian int64
+        std::cout << "# binary type no program name";
+        numValues = 0;
+        if (gpuTimes) {
+            std::cout << " gpu_start gpu_dura";
+            numValues += 2;
+        }
+        if (cpuTimes) {
+            std::cout << " cpu_start cpu_dura";
+            numValues += 2;
+        }
+        if (memoryUsage) {
+            std::cout << " vsize_start vsize_dura rss_start rss_dura";
+            numValues += 4;
+        }
+        if (pixelsDrawn) {
+            std::cout << " pixels";
+            numValues += 1;
+        }
+        std::cout << std::endl;
+        return;
+    }
 
     std::cout << "# call no gpu_start gpu_dura cpu_start cpu_dura vsize_start vsize_dura rss_start rss_dura pixels program name" << std::endl;
 }
 
+static inline void
+putInt(char * &p, uint64_t value, unsigned size)
+{
+    for (unsigned i = 0; i < size; ++i) {
+        *p++ = (char)(value >> (8*i));
+    }
+}
+
+/**
+ * Write a record, made of a type char, three uint32 (call no, program, and
+ * name id), and numValues int64.
+ */
+void Profiler::writeRecord(char type, unsigned no, unsigned program, unsigned name, const int64_t *values)
+{
+    char record[1 + 3*4 + 9*8];
+    char *p = record;
+    *p++ = type;
+    putInt(p, no, 4);
+    putInt(p, program, 4);
+    putInt(p, name, 4);
+    for (unsigned i = 0; i < numValues; ++i) {
+        putInt(p, values ? values[i] : 0, 8);
+    }
+    std::cout.write(record, p - record);
+}
+
+/**
+ * Get the id of a call name, defining it on first use with an 'n' record
+ * (with the id and the name length), followed by as many 'd' records as
+ * needed to hold the name characters after their type char.
+ */
+unsigned Profiler::getNameId(const char *name)
+{
+    std::map<std::string, unsigned>::iterator it = nameIds.find(name);
+    if (it != nameIds.end()) {
+        return it->second;
+    }
+
+    unsigned id = (unsigned)nameIds.size();
+    nameIds[name] = id;
+
+    size_t length = strlen(name);
+    writeRecord('n', id, 0, (unsigned)length, NULL);
+
+    char record[1 + 3*4 + 9*8];
+    size_t recordSize = 1 + 3*4 + numValues*8;
+    for (size_t offset = 0; offset < length; offset += recordSize - 1) {
+        size_t count = std::min(recordSize - 1, length - offset);
+        memset(record, 0, recordSize);
+        record[0] = 'd';
+        memcpy(record + 1, name + offset, count);
+        std::cout.write(record, recordSize);
+    }
+
+    return id;
+}
+
 int64_t Profiler::getBaseCpuTime()
 {
     return baseCpuTime;
@@ -140,6 +225,31 @@ void Profiler::addCall(unsigned no,
         rssDuration = 0;
     }
 
+    if (binary) {
+        int64_t values[9];
+        unsigned i = 0;
+        if (gpuTimes) {
+            values[i++] = gpuStart;
+            values[i++] = gpuDuration;
+        }
+        if (cpuTimes) {
+            values[i++] = cpuStart;
+            values[i++] = cpuDuration;
+        }
+        if (memoryUsage) {
+            values[i++] = vsizeStart;
+            values[i++] = vsizeDuration;
+            values[i++] = rssStart;
+            values[i++] = rssDuration;
+        }
+        if (pixelsDrawn) {
+            values[i++] = pixels;
+        }
+        unsigned nameId = getNameId(name);
+        writeRecord('c', no, program, nameId, values);
+        return;
+    }
+
     std::cout << "call"
               << " " << no
               << " " << gpuStart
@@ -158,6 +268,11 @@ void Profiler::addCall(unsigned no,
 
 void Profiler::addFrameEnd()
 {
+    if (binary) {
+        writeRecord('f', 0, 0, 0, NULL);
+        return;
+    }
+
     std::cout << "frame_end" << std::endl;
 }
 
@@ -26,6 +26,7 @@
 
 #pragma once
 
+#include <map>
 #include <string>
 #include <vector>
 #include <stdint.h>
@@ -100,7 +101,7 @@ public:
     Profiler();
     ~Profiler();
 
-    void setup(bool cpuTimes_, bool gpuTimes_, bool pixelsDrawn_, bool memoryUsage_);
+    void setup(bool cpuTimes_, bool gpuTimes_, bool pixelsDrawn_, bool memoryUsage_, bool binary_ = false);
 
     void addCall(unsigned no,
                  const char* name,
@@ -138,6 +139,17 @@ private:
     bool gpuTimes;
     bool pixelsDrawn;
     bool memoryUsage;
+
+    /*
+     * Binary output, made of fixed size records, as described by a text
+     * header line.  See scripts/profileread.py.
+     */
+    bool binary;
+    unsigned numValues;
+    std::map<std::string, unsigned> nameIds;
+
+    void writeRecord(char type, unsigned no, unsigned program, unsigned name, const int64_t *values);
+    unsigned getNameId(const char *name);
 };
 }
 
@@ -26,6 +26,7 @@
 
 #include <assert.h>
 #include <stdarg.h>
+#include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
@@ -40,13 +41,104 @@
 namespace trace {
 
 
+/**
+ * Number of blobs to remember for writing references to them.
+ */
+static const size_t maxBlobRefs = 64*1024;
+
+
+static inline uint64_t
+rotl64(uint64_t x, int r) {
+    return (x << r) | (x >> (64 - r));
+}
+
+static inline uint64_t
+fmix64(uint64_t k) {
+    k ^= k >> 33;
+    k *= 0xff51afd7ed558ccdULL;
+    k ^= k >> 33;
+    k *= 0xc4ceb9fe1a85ec53ULL;
+    k ^= k >> 33;
+    return k;
+}
+
+/**
+ * 128 bits hash of the blob contents, after Austin Appleby's public domain
+ * MurmurHash3_x64_128, but zero-padding the tail.
+ *
+ * A cryptographic hash such as MD5 would be several times slower, while
+ * there is no adversary to guard against here.
+ */
+static void
+hashBlob(const void *data, size_t size, uint64_t hash[2]) {
+    const uint64_t c1 = 0x87c37b91114253d5ULL;
+    const uint64_t c2 = 0x4cf5ad432745937fULL;
+
+    const unsigned char *p = static_cast<const unsigned char *>(data);
+    uint64_t h1 = 0;
+    uint64_t h2 = 0;
+
+    for (size_t remaining = size; remaining; ) {
+        uint64_t block[2];
+        if (remaining >= sizeof block) {
+            memcpy(block, p, sizeof block);
+            p += sizeof block;
+            remaining -= sizeof block;
+        } else {
+            block[0] = 0;
+            block[1] = 0;
+            memcpy(block, p, remaining);
+            remaining = 0;
+        }
+
+        uint64_t k1 = block[0];
+        k1 *= c1;
+        k1 = rotl64(k1, 31);
+        k1 *= c2;
+        h1 ^= k1;
+        h1 = rotl64(h1, 27);
+        h1 += h2;
+        h1 = h1 * 5 + 0x52dce729;
+
+        uint64_t k2 = block[1];
+        k2 *= c2;
+        k2 = rotl64(k2, 33);
+        k2 *= c1;
+        h2 ^= k2;
+        h2 = rotl64(h2, 31);
+        h2 += h1;
+        h2 = h2 * 5 + 0x38495ab5;
+    }
+
+    h1 ^= size;
+    h2 ^= size;
+    h1 += h2;
+    h2 += h1;
+    h1 = fmix64(h1);
+    h2 = fmix64(h2);
+    h1 += h2;
+    h2 += h1;
+
+    hash[0] = h1;
+    hash[1] = h2;
+}
+
+
 Writer::Writer() :
-    call_no(0)
+    call_no(0),
+    next_blob_id(0)
 {
     m_file = File::createSnappy();
     close();
 }
 
+Writer::Writer(File *file) :
+    m_file(file),
+    call_no(0),
+    next_blob_id(0)
+{
+}
+
 Writer::~Writer()
 {
     close();
@@ -73,6 +165,9 @@ Writer::open(const char *filename) {
     enums.clear();
     bitmasks.clear();
     frames.clear();
+    blobs.clear();
+    blobOrder.clear();
+    next_blob_id = 0;
 
     _writeUInt(TRACE_VERSION);
 
@@ -146,6 +241,7 @@ void Writer::beginBacktrace(unsigned num_frames) {
 void Writer::writeStackFrame(const RawStackFrame *frame) {
     _writeUInt(frame->id);
     if (!lookup(frames, frame->id)) {
+        beginSignature();
         if (frame->module != NULL) {
             _writeByte(trace::BACKTRACE_MODULE);
             _writeString(frame->module);
@@ -167,6 +263,7 @@ void Writer::writeStackFrame(const RawStackFrame *frame) {
             _writeUInt(frame->offset);
         }
         _writeByte(trace::BACKTRACE_END);
+        endSignature(SIGNATURE_FRAME, frame->id);
         frames[frame->id] = true;
     }
 }
@@ -176,11 +273,13 @@ unsigned Writer::beginEnter(const FunctionSig *sig, unsigned thread_id) {
     _writeUInt(thread_id);
     _writeUInt(sig->id);
     if (!lookup(functions, sig->id)) {
+        beginSignature();
         _writeString(sig->name);
         _writeUInt(sig->num_args);
         for (unsigned i = 0; i < sig->num_args; ++i) {
             _writeString(sig->arg_names[i]);
         }
+        endSignature(SIGNATURE_FUNCTION, sig->id);
         functions[sig->id] = true;
     }
 
@@ -218,11 +317,13 @@ void Writer::beginStruct(const StructSig *sig) {
     _writeByte(trace::TYPE_STRUCT);
     _writeUInt(sig->id);
     if (!lookup(structs, sig->id)) {
+        beginSignature();
         _writeString(sig->name);
         _writeUInt(sig->num_members);
         for (unsigned i = 0; i < sig->num_members; ++i) {
             _writeString(sig->member_names[i]);
         }
+        endSignature(SIGNATURE_STRUCT, sig->id);
         structs[sig->id] = true;
     }
 }
@@ -317,6 +418,45 @@ void Writer::writeBlob(const void *data, size_t size) {
         Writer::writeNull();
         return;
     }
+    if (size < minBlobRefSize) {
+        writeBlobData(data, size);
+        return;
+    }
+
+    BlobKey key;
+    hashBlob(data, size, key.hash);
+    key.size = size;
+
+    _writeByte(trace::TYPE_BLOB_REF);
+
+    BlobMap::iterator it = blobs.lower_bound(key);
+    if (it != blobs.end() && !(key < it->first)) {
+        BlobRef &ref = it->second;
+        blobOrder.splice(blobOrder.end(), blobOrder, ref.order);
+        _writeUInt(ref.id);
+        return;
+    }
+
+    if (blobs.size() >= maxBlobRefs) {
+        BlobMap::iterator oldest = blobs.find(blobOrder.front());
+        if (oldest == it) {
+            ++it;
+        }
+        blobs.erase(oldest);
+        blobOrder.pop_front();
+    }
+
+    BlobRef ref;
+    ref.id = next_blob_id++;
+    ref.order = blobOrder.insert(blobOrder.end(), key);
+    blobs.insert(it, std::make_pair(key, ref));
+
+    _writeUInt(ref.id);
+    _writeUInt(size);
+    _write(data, size);
+}
+
+void Writer::writeBlobData(const void *data, size_t size) {
     _writeByte(trace::TYPE_BLOB);
     _writeUInt(size);
     if (size) {
@@ -328,11 +468,13 @@ void Writer::writeEnum(const EnumSig *sig, signed long long value) {
     _writeByte(trace::TYPE_ENUM);
     _writeUInt(sig->id);
     if (!lookup(enums, sig->id)) {
+        beginSignature();
         _writeUInt(sig->num_values);
         for (unsigned i = 0; i < sig->num_values; ++i) {
             _writeString(sig->values[i].name);
             writeSInt(sig->values[i].value);
         }
+        endSignature(SIGNATURE_ENUM, sig->id);
         enums[sig->id] = true;
     }
     writeSInt(value);
@@ -342,6 +484,7 @@ void Writer::writeBitmask(const BitmaskSig *sig, unsigned long long value) {
     _writeByte(trace::TYPE_BITMASK);
     _writeUInt(sig->id);
     if (!lookup(bitmasks, sig->id)) {
+        beginSignature();
         _writeUInt(sig->num_flags);
         for (unsigned i = 0; i < sig->num_flags; ++i) {
             if (i != 0 && sig->flags[i].value == 0) {
@@ -350,6 +493,7 @@ void Writer::writeBitmask(const BitmaskSig *sig, unsigned long long value) {
             _writeString(sig->flags[i].name);
             _writeUInt(sig->flags[i].value);
         }
+        endSignature(SIGNATURE_BITMASK, sig->id);
         bitmasks[sig->id] = true;
     }
     _writeUInt(value);
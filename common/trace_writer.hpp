@@ -31,7 +31,10 @@
 
 
 #include <stddef.h>
+#include <stdint.h>
 
+#include <list>
+#include <map>
 #include <vector>
 
 #include "trace_model.hpp"
@@ -50,9 +53,38 @@ namespace trace {
         std::vector<bool> bitmasks;
         std::vector<bool> frames;
 
+        /**
+         * Blobs written so far, by size and hash, so that repeated ones are
+         * written as references to the first.  Only the most recently
+         * used ones are remembered.
+         */
+        struct BlobKey {
+            uint64_t hash[2];
+            size_t size;
+
+            bool operator < (const BlobKey &other) const {
+                if (size != other.size) {
+                    return size < other.size;
+                }
+                if (hash[0] != other.hash[0]) {
+                    return hash[0] < other.hash[0];
+                }
+                return hash[1] < other.hash[1];
+            }
+        };
+        typedef std::list<BlobKey> BlobOrder;
+        struct BlobRef {
+            unsigned id;
+            BlobOrder::iterator order;
+        };
+        typedef std::map<BlobKey, BlobRef> BlobMap;
+        BlobMap blobs;
+        BlobOrder blobOrder;
+        unsigned next_blob_id;
+
     public:
         Writer();
-        ~Writer();
+        virtual ~Writer();
 
         bool open(const char *filename);
         void close(void);
@@ -103,6 +135,38 @@ namespace trace {
         void writeCall(Call *call);
 
     protected:
+        /**
+         * Write to the given file, which will be owned by the writer, and
+         * is assumed to be opened already.
+         */
+        Writer(File *file);
+
+        enum SignatureKind {
+            SIGNATURE_FUNCTION,
+            SIGNATURE_STRUCT,
+            SIGNATURE_ENUM,
+            SIGNATURE_BITMASK,
+            SIGNATURE_FRAME,
+        };
+
+        /**
+         * Called around the definitions of signatures (and stack frames),
+         * which are written along with their first use only.
+         */
+        virtual void beginSignature(void) {}
+        virtual void endSignature(SignatureKind kind, unsigned id) {}
+
+        /**
+         * Blobs smaller than this are always written in full, as references
+         * wouldn't save much.
+         */
+        static const size_t minBlobRefSize = 256;
+
+        /**
+         * Write a blob in full, regardless of any earlier identical blob.
+         */
+        void writeBlobData(const void *data, size_t size);
+
         void inline _write(const void *sBuffer, size_t dwBytesToWrite);
         void inline _writeByte(char c);
         void inline _writeUInt(unsigned long long value);
@@ -30,6 +30,9 @@
 #include <stdlib.h>
 #include <string.h>
 
+#include <algorithm>
+#include <map>
+
 #include "os.hpp"
 #include "os_thread.hpp"
 #include "os_string.hpp"
@@ -56,6 +59,199 @@ static const char *realloc_args[2] = {"ptr", "size"};
 const FunctionSig realloc_sig = {3, "realloc", 2, realloc_args};
 
 
+/**
+ * Default bound for the bytes of serialized events waiting to be written,
+ * above which threads wait for the background thread to catch up before
+ * serializing more.  It can be overridden in megabytes with the
+ * TRACE_BUFFER_SIZE environment variable.
+ */
+static const size_t defaultBufferSize = 64*1024*1024;
+
+/**
+ * Bytes of serialized events to accumulate before waking the background
+ * thread, as the trace file would buffer as much before writing anyway.
+ */
+static const size_t minPendingSize = 1024*1024;
+
+static const uint64_t idleKey = ~(uint64_t)0;
+
+
+/**
+ * File that appends to the event being serialized by a ThreadWriter.
+ */
+class EventFile : public File {
+public:
+    EventFile(ThreadWriter *writer) :
+        m_writer(writer)
+    {
+        m_mode = File::Write;
+        m_isOpened = true;
+    }
+
+    bool supportsOffsets() const {
+        return false;
+    }
+
+    File::Offset currentOffset() {
+        return File::Offset();
+    }
+
+protected:
+    bool rawOpen(const std::string &filename, File::Mode mode) {
+        return mode == File::Write;
+    }
+
+    bool rawWrite(const void *buffer, size_t length) {
+        assert(m_writer->event);
+        m_writer->event->data.append(static_cast<const char *>(buffer), length);
+        return true;
+    }
+
+    size_t rawRead(void *buffer, size_t length) {
+        return 0;
+    }
+
+    int rawGetc() {
+        return -1;
+    }
+
+    void rawClose() {
+    }
+
+    void rawFlush() {
+    }
+
+    bool rawSkip(size_t length) {
+        return false;
+    }
+
+    int rawPercentRead() {
+        return 0;
+    }
+
+private:
+    ThreadWriter *m_writer;
+};
+
+
+ThreadWriter::ThreadWriter() :
+    Writer(new EventFile(this)),
+    thread_id(0),
+    event(NULL),
+    busyKey(idleKey),
+    signatureBegin(0)
+{
+}
+
+void ThreadWriter::beginSignature(void) {
+    signatureBegin = event->data.size();
+}
+
+void ThreadWriter::endSignature(SignatureKind kind, unsigned id) {
+    Signature signature;
+    signature.kind = kind;
+    signature.id = id;
+    signature.begin = signatureBegin;
+    signature.end = event->data.size();
+    event->signatures.push_back(signature);
+}
+
+void ThreadWriter::writeBlob(const void *data, size_t size) {
+    if (!data || size < minBlobRefSize) {
+        Writer::writeBlob(data, size);
+        return;
+    }
+    BlobRange blob;
+    blob.begin = event->data.size();
+    writeBlobData(data, size);
+    blob.end = event->data.size();
+    blob.size = size;
+    event->blobs.push_back(blob);
+}
+
+
+OS_THREAD_SPECIFIC_PTR(ThreadWriter) threadWriter;
+
+
+struct LocalWriter::Queue {
+    /**
+     * Protects all members below but outputMutex.  It is only held for
+     * brief periods, never while serializing or writing.
+     */
+    os::mutex mutex;
+
+    /**
+     * Serialized events, by key.  Events with the same key (leaves of
+     * different threads) keep their insertion order.
+     */
+    typedef std::multimap<uint64_t, ThreadWriter::Event *> EventMap;
+    EventMap pending;
+    size_t pendingSize;
+
+    /**
+     * Bound for pendingSize, and how much of it is written at a time, so
+     * that waiting threads resume before all pending events are written.
+     */
+    size_t maxPendingSize;
+    size_t batchSize;
+
+    std::vector<ThreadWriter::Event *> freeEvents;
+
+    /**
+     * All writers, and those not lent to any thread.  Writers are returned
+     * after each event, so there are only as many as the events serialized
+     * at the same time, however many threads come and go.
+     */
+    std::vector<ThreadWriter *> writers;
+    std::vector<ThreadWriter *> freeWriters;
+
+    /**
+     * Signaled when events are queued while the background thread waits.
+     */
+    os::condition_variable queuedCond;
+    bool waiting;
+
+    /**
+     * Signaled when events were written, for the threads waiting for the
+     * pending events to shrink.
+     */
+    os::condition_variable writtenCond;
+    unsigned throttled;
+
+    bool exiting;
+
+    /**
+     * Held while writing into the trace file.
+     *
+     * We need a recursive mutex here, so that flushing the trace file from
+     * the exception handler doesn't deadlock when the exception happens
+     * while writing it.
+     */
+    os::recursive_mutex outputMutex;
+
+    /**
+     * Events being written, only accessed while holding outputMutex.
+     */
+    std::vector<ThreadWriter::Event *> batch;
+
+    /**
+     * The background thread.  It is never joined, as that is prone to
+     * deadlocks while unloading (e.g., on Windows' loader lock), so the
+     * queue is never freed either.
+     */
+    os::thread thread;
+
+    Queue(size_t bufferSize) :
+        pendingSize(0),
+        maxPendingSize(bufferSize),
+        batchSize(std::max(bufferSize / 4, (size_t)1)),
+        waiting(false),
+        throttled(0),
+        exiting(false)
+    {}
+};
+
+
 static void exceptionCallback(void)
 {
     localWriter.flush();
@@ -63,6 +259,7 @@ static void exceptionCallback(void)
 
 
 LocalWriter::LocalWriter() :
+    queue(NULL),
     acquired(0)
 {
     os::String process = os::getProcessName();
@@ -78,6 +275,23 @@ LocalWriter::~LocalWriter()
     os::resetExceptionCallback();
     checkProcessId();
 
+    Queue *q = queue;
+    if (q) {
+        // Stop the background thread, and write whatever events are
+        // complete.
+        q->outputMutex.lock();
+        q->mutex.lock();
+        q->exiting = true;
+        q->queuedCond.notify_one();
+        for (unsigned i = 0; i < q->throttled; ++i) {
+            q->writtenCond.notify_one();
+        }
+        q->mutex.unlock();
+        while (writeEvents())
+            ;
+        q->outputMutex.unlock();
+    }
+
     os::String process = os::getProcessName();
     os::log("apitrace: unloaded from %s\n", process.str());
 }
@@ -146,6 +360,21 @@ LocalWriter::open(void) {
 
     pid = os::getCurrentProcessId();
 
+    size_t bufferSize = defaultBufferSize;
+    const char *szBufferSize = getenv("TRACE_BUFFER_SIZE");
+    if (szBufferSize) {
+        char *end = NULL;
+        unsigned long megabytes = strtoul(szBufferSize, &end, 10);
+        if (end == szBufferSize || *end || !megabytes) {
+            os::log("apitrace: warning: ignoring invalid TRACE_BUFFER_SIZE %s\n", szBufferSize);
+        } else {
+            bufferSize = (size_t)megabytes * 1024 * 1024;
+        }
+    }
+
+    queue = new Queue(bufferSize);
+    queue->thread = os::thread(writerThread, this);
+
 #if 0
     // For debugging the exception handler
     *((int *)0) = 0;
@@ -157,13 +386,17 @@ static uintptr_t next_thread_num = 1;
 static OS_THREAD_SPECIFIC(uintptr_t)
 thread_num;
 
+static os::mutex openMutex;
+
 void LocalWriter::checkProcessId(void) {
-    if (m_file->isOpened() &&
+    if (queue &&
         os::getCurrentProcessId() != pid) {
         // We are a forked child process that inherited the trace file, so
         // create a new file.  We can't call any method of the current
         // file, as it may cause it to flush and corrupt the parent's
-        // trace, so we effectively leak the old file object.
+        // trace, so we effectively leak the old file object.  Likewise for
+        // the queue, whose mutexes might have been held by the parent's
+        // threads.
         m_file = File::createSnappy();
         // Don't want to open the same file again
         os::unsetEnvironment("TRACE_FILE");
@@ -171,76 +404,324 @@ void LocalWriter::checkProcessId(void) {
     }
 }
 
-unsigned LocalWriter::beginEnter(const FunctionSig *sig, bool fake) {
-    mutex.lock();
-    ++acquired;
+/**
+ * Start serializing an event in the current thread's writer.
+ *
+ * Events are written in the order of their keys.  The enter of call N has
+ * key 2*N + 1, so that calls keep the numbers they were assigned here, while
+ * a leave gets 2*N, where N is the number of calls entered so far, so that it
+ * follows the enter of its own call, and precedes any enter that follows it.
+ */
+unsigned LocalWriter::beginEvent(bool enter) {
+    Queue *q = queue;
+    os::unique_lock<os::mutex> lock(q->mutex);
+
+    // Let the background thread catch up
+    if (q->pendingSize > q->maxPendingSize) {
+        ++q->throttled;
+        do {
+            q->writtenCond.wait(lock);
+        } while (q->pendingSize > q->maxPendingSize && !q->exiting);
+        --q->throttled;
+    }
 
-    checkProcessId();
-    if (!m_file->isOpened()) {
-        open();
+    // Borrow a writer.  Forked processes start with a new queue, and thus
+    // new writers, so that signatures are defined again in their trace files.
+    ThreadWriter *writer;
+    if (q->freeWriters.empty()) {
+        writer = new ThreadWriter;
+        q->writers.push_back(writer);
+    } else {
+        writer = q->freeWriters.back();
+        q->freeWriters.pop_back();
     }
+    threadWriter = writer;
 
     uintptr_t this_thread_num = thread_num;
     if (!this_thread_num) {
         this_thread_num = next_thread_num++;
         thread_num = this_thread_num;
     }
+    writer->thread_id = this_thread_num - 1;
+
+    ThreadWriter::Event *event;
+    if (q->freeEvents.empty()) {
+        event = new ThreadWriter::Event;
+    } else {
+        event = q->freeEvents.back();
+        q->freeEvents.pop_back();
+    }
+
+    unsigned call = call_no;
+    if (enter) {
+        event->key = 2 * (uint64_t)call + 1;
+        ++call_no;
+    } else {
+        event->key = 2 * (uint64_t)call;
+    }
+
+    writer->event = event;
+    writer->busyKey = event->key;
+
+    return call;
+}
+
+void LocalWriter::endEvent(void) {
+    ThreadWriter *writer = threadWriter;
+    ThreadWriter::Event *event = writer->event;
+
+    Queue *q = queue;
+    os::unique_lock<os::mutex> lock(q->mutex);
+
+    writer->event = NULL;
+    writer->busyKey = idleKey;
+    q->freeWriters.push_back(writer);
+    threadWriter = NULL;
+
+    q->pending.insert(q->pending.end(), std::make_pair(event->key, event));
+    q->pendingSize += event->data.size();
+
+    if (q->waiting &&
+        q->pendingSize >= std::min(minPendingSize, q->batchSize)) {
+        q->waiting = false;
+        q->queuedCond.notify_one();
+    }
+}
+
+/**
+ * Highest key that can be written, as no event with a lower or equal key
+ * can still be queued.  Must be called with the queue mutex held.
+ */
+uint64_t LocalWriter::getMaxKey(void) {
+    const std::vector<ThreadWriter *> &writers = queue->writers;
+    uint64_t maxKey = 2 * (uint64_t)call_no;
+    for (size_t i = 0; i < writers.size(); ++i) {
+        maxKey = std::min(maxKey, writers[i]->busyKey);
+    }
+    return maxKey;
+}
+
+static inline bool
+define(std::vector<bool> &map, size_t index) {
+    if (index >= map.size()) {
+        map.resize(index + 1);
+    } else if (map[index]) {
+        return false;
+    }
+    map[index] = true;
+    return true;
+}
+
+void LocalWriter::writeEvent(const ThreadWriter::Event *event) {
+    const char *data = event->data.data();
+    size_t pos = 0;
+    size_t j = 0;
+
+    // Signatures are defined by each thread on its first use, so drop all
+    // but the first definition in the file.
+    for (size_t i = 0; i < event->signatures.size(); ++i) {
+        const ThreadWriter::Signature &signature = event->signatures[i];
+        pos = writeBlobs(event, pos, j, signature.begin);
+        std::vector<bool> *map;
+        switch (signature.kind) {
+        case SIGNATURE_FUNCTION:
+            map = &functions;
+            break;
+        case SIGNATURE_STRUCT:
+            map = &structs;
+            break;
+        case SIGNATURE_ENUM:
+            map = &enums;
+            break;
+        case SIGNATURE_BITMASK:
+            map = &bitmasks;
+            break;
+        case SIGNATURE_FRAME:
+            map = &frames;
+            break;
+        default:
+            assert(0);
+            continue;
+        }
+        if (!define(*map, signature.id)) {
+            m_file->write(data + pos, signature.begin - pos);
+            pos = signature.end;
+        }
+    }
+
+    pos = writeBlobs(event, pos, j, event->data.size());
+
+    m_file->write(data + pos, event->data.size() - pos);
+}
+
+/**
+ * Write the event data from pos up to the given end, deduplicating the
+ * blobs therein, starting with the j-th, and returning the position written
+ * up to.
+ */
+size_t LocalWriter::writeBlobs(const ThreadWriter::Event *event, size_t pos, size_t &j, size_t end) {
+    const char *data = event->data.data();
+    for (; j < event->blobs.size() && event->blobs[j].begin < end; ++j) {
+        const ThreadWriter::BlobRange &blob = event->blobs[j];
+        m_file->write(data + pos, blob.begin - pos);
+        Writer::writeBlob(data + blob.end - blob.size, blob.size);
+        pos = blob.end;
+    }
+    return pos;
+}
+
+/**
+ * Write the next batch of events that can be written, returning false if
+ * there were none.  Must be called with the output mutex held.
+ */
+bool LocalWriter::writeEvents(void) {
+    Queue *q = queue;
+    std::vector<ThreadWriter::Event *> &batch = q->batch;
+
+    q->mutex.lock();
+    uint64_t maxKey = getMaxKey();
+    size_t batchSize = 0;
+    Queue::EventMap::iterator it = q->pending.begin();
+    while (it != q->pending.end() && it->first <= maxKey &&
+           batchSize < q->batchSize) {
+        batch.push_back(it->second);
+        batchSize += it->second->data.size();
+        ++it;
+    }
+    q->pendingSize -= batchSize;
+    q->pending.erase(q->pending.begin(), it);
+    q->mutex.unlock();
+
+    if (batch.empty()) {
+        return false;
+    }
+
+    ++acquired;
+    for (size_t i = 0; i < batch.size(); ++i) {
+        writeEvent(batch[i]);
+    }
+    --acquired;
+
+    q->mutex.lock();
+    for (size_t i = 0; i < batch.size(); ++i) {
+        ThreadWriter::Event *event = batch[i];
+        if (event->data.capacity() > 1024*1024) {
+            // Don't hold on to the memory of huge blobs
+            std::string().swap(event->data);
+        } else {
+            event->data.clear();
+        }
+        event->signatures.clear();
+        event->blobs.clear();
+        q->freeEvents.push_back(event);
+    }
+    for (unsigned i = 0; i < q->throttled; ++i) {
+        q->writtenCond.notify_one();
+    }
+    q->mutex.unlock();
+
+    batch.clear();
+
+    return true;
+}
+
+void LocalWriter::writerThread(LocalWriter *writer) {
+    Queue *q = writer->queue;
+
+    for (;;) {
+        {
+            os::unique_lock<os::mutex> lock(q->mutex);
+            while (!q->exiting &&
+                   (q->pending.empty() ||
+                    q->pending.begin()->first > writer->getMaxKey())) {
+                q->waiting = true;
+                q->queuedCond.wait(lock);
+            }
+            if (q->exiting) {
+                return;
+            }
+        }
+
+        q->outputMutex.lock();
+        q->mutex.lock();
+        bool exiting = q->exiting;
+        q->mutex.unlock();
+        if (!exiting) {
+            writer->writeEvents();
+        }
+        q->outputMutex.unlock();
+    }
+}
 
-    assert(this_thread_num);
-    unsigned thread_id = this_thread_num - 1;
-    unsigned call_no = Writer::beginEnter(sig, thread_id);
+unsigned LocalWriter::beginEnter(const FunctionSig *sig, bool fake) {
+    if (!queue || os::getCurrentProcessId() != pid) {
+        openMutex.lock();
+        if (!queue) {
+            open();
+        } else {
+            checkProcessId();
+        }
+        openMutex.unlock();
+    }
+
+    unsigned call = beginEvent(true);
+
+    ThreadWriter *writer = threadWriter;
+    writer->beginEnter(sig, writer->thread_id);
     if (!fake && os::backtrace_is_needed(sig->name)) {
         std::vector<RawStackFrame> backtrace = os::get_backtrace();
-        beginBacktrace(backtrace.size());
+        writer->beginBacktrace(backtrace.size());
         for (unsigned i = 0; i < backtrace.size(); ++i) {
-            writeStackFrame(&backtrace[i]);
+            writer->writeStackFrame(&backtrace[i]);
         }
-        endBacktrace();
+        writer->endBacktrace();
     }
-    return call_no;
+    return call;
 }
 
 void LocalWriter::endEnter(void) {
-    Writer::endEnter();
-    --acquired;
-    mutex.unlock();
+    threadWriter->endEnter();
+    endEvent();
 }
 
 void LocalWriter::beginLeave(unsigned call) {
-    mutex.lock();
-    ++acquired;
-    Writer::beginLeave(call);
+    beginEvent(false);
+    threadWriter->beginLeave(call);
 }
 
 void LocalWriter::endLeave(void) {
-    Writer::endLeave();
-    --acquired;
-    mutex.unlock();
+    threadWriter->endLeave();
+    endEvent();
 }
 
 void LocalWriter::flush(void) {
     /*
-     * Do nothing if the mutex is already acquired (e.g., if a segfault happen
-     * while writing the file) as state could be inconsistent, therefore yield
-     * inconsistent trace files and/or repeated segfaults till infinity.
+     * Do nothing if the trace file is being written (e.g., if a segfault
+     * happen while writing the file) as state could be inconsistent,
+     * therefore yield inconsistent trace files and/or repeated segfaults till
+     * infinity.
      */
 
-    mutex.lock();
+    Queue *q = queue;
+    if (!q) {
+        return;
+    }
+
+    if (os::getCurrentProcessId() != pid) {
+        os::log("apitrace: ignoring exception in child process\n");
+        return;
+    }
+
+    q->outputMutex.lock();
     if (acquired) {
         os::log("apitrace: ignoring exception while tracing\n");
     } else {
-        ++acquired;
-        if (m_file->isOpened()) {
-            if (os::getCurrentProcessId() != pid) {
-                os::log("apitrace: ignoring exception in child process\n");
-            } else {
-                os::log("apitrace: flushing trace due to an exception\n");
-                m_file->flush();
-            }
-        }
-        --acquired;
+        os::log("apitrace: flushing trace due to an exception\n");
+        while (writeEvents())
+            ;
+        m_file->flush();
     }
-    mutex.unlock();
+    q->outputMutex.unlock();
 }
 
 
@@ -283,5 +764,140 @@ void fakeMemcpy(const void *ptr, size_t size) {
 }
 
 
+/*
+ * Mapping shadows.
+ */
+
+/**
+ * Granularity of the comparison with the shadow copies.
+ */
+static const size_t shadowBlockSize = 64;
+
+static bool
+getShadowingMappings(void) {
+    const char *value = getenv("TRACE_DIFF_MAPS");
+    return value && value[0] && strcmp(value, "0") != 0;
+}
+
+static const bool shadowingMappings = getShadowingMappings();
+
+struct MappingShadow {
+    size_t size;
+    char *data;
+};
+
+typedef std::map<uintptr_t, MappingShadow> MappingShadowMap;
+
+static MappingShadowMap mappingShadows;
+static os::mutex mappingShadowsMutex;
+
+/**
+ * Drop the shadows overlapping [start, end).  Must be called with the
+ * shadows mutex held.
+ */
+static void
+eraseMappingShadows(uintptr_t start, uintptr_t end) {
+    MappingShadowMap::iterator it = mappingShadows.lower_bound(start);
+    if (it != mappingShadows.begin()) {
+        MappingShadowMap::iterator prev = it;
+        --prev;
+        if (prev->first + prev->second.size > start) {
+            it = prev;
+        }
+    }
+    while (it != mappingShadows.end() && it->first < end) {
+        free(it->second.data);
+        mappingShadows.erase(it++);
+    }
+}
+
+bool isShadowingMappings(void) {
+    return shadowingMappings;
+}
+
+void shadowMapping(const void *ptr, size_t size) {
+    if (!shadowingMappings || !ptr) {
+        return;
+    }
+
+    uintptr_t start = (uintptr_t)ptr;
+
+    MappingShadow shadow;
+    shadow.size = size;
+    shadow.data = size ? (char *)malloc(size) : NULL;
+    if (shadow.data) {
+        memcpy(shadow.data, ptr, size);
+    }
+
+    os::unique_lock<os::mutex> lock(mappingShadowsMutex);
+    eraseMappingShadows(start, start + std::max(size, (size_t)1));
+    if (shadow.data) {
+        mappingShadows[start] = shadow;
+    }
+}
+
+void unshadowMapping(const void *ptr, size_t size) {
+    if (!shadowingMappings || !ptr) {
+        return;
+    }
+
+    uintptr_t start = (uintptr_t)ptr;
+
+    os::unique_lock<os::mutex> lock(mappingShadowsMutex);
+    eraseMappingShadows(start, start + std::max(size, (size_t)1));
+}
+
+void fakeMemcpyModified(const void *ptr, size_t size) {
+    assert(ptr);
+    if (!size) {
+        return;
+    }
+
+    if (!shadowingMappings) {
+        fakeMemcpy(ptr, size);
+        return;
+    }
+
+    const char *mapping = (const char *)ptr;
+    uintptr_t start = (uintptr_t)ptr;
+    std::vector< std::pair<size_t, size_t> > regions;
+
+    mappingShadowsMutex.lock();
+
+    // Find the shadow holding the whole range, if any
+    MappingShadowMap::iterator it = mappingShadows.upper_bound(start);
+    if (it != mappingShadows.begin()) {
+        --it;
+    }
+    if (it == mappingShadows.end() ||
+        it->first > start ||
+        it->first + it->second.size < start + size) {
+        mappingShadowsMutex.unlock();
+        fakeMemcpy(ptr, size);
+        return;
+    }
+
+    char *shadow = it->second.data + (start - it->first);
+    for (size_t offset = 0; offset < size; offset += shadowBlockSize) {
+        size_t length = std::min(shadowBlockSize, size - offset);
+        if (memcmp(mapping + offset, shadow + offset, length) != 0) {
+            memcpy(shadow + offset, mapping + offset, length);
+            if (!regions.empty() &&
+                regions.back().first + regions.back().second == offset) {
+                regions.back().second += length;
+            } else {
+                regions.push_back(std::make_pair(offset, length));
+            }
+        }
+    }
+
+    mappingShadowsMutex.unlock();
+
+    for (size_t i = 0; i < regions.size(); ++i) {
+        fakeMemcpy(mapping + regions[i].first, regions[i].second);
+    }
+}
+
+
 } /* namespace trace */
 
@@ -32,6 +32,9 @@
 
 #include <stdint.h>
 
+#include <string>
+#include <vector>
+
 #include "os_thread.hpp"
 #include "os_process.hpp"
 #include "trace_writer.hpp"
@@ -44,30 +47,105 @@ namespace trace {
     extern const FunctionSig free_sig;
     extern const FunctionSig realloc_sig;
 
+    class LocalWriter;
+
+    /**
+     * Serializes events of a thread into memory, without any locking.
+     *
+     * Each event (the enter or leave of a call) is serialized into its own
+     * buffer, which LocalWriter later merges into the trace file.  Writers
+     * are pooled, serializing one event at a time for any thread.  As
+     * signatures are defined on their first use by each writer, the
+     * definitions are recorded, so that only the first one in the trace
+     * file is kept.  Likewise for blobs, which are written in full, so that
+     * they can be written as references to identical blobs when merged.
+     */
+    class ThreadWriter : public Writer {
+    public:
+        struct Signature {
+            SignatureKind kind;
+            unsigned id;
+            size_t begin;
+            size_t end;
+        };
+
+        struct BlobRange {
+            size_t begin;
+            size_t end;
+            size_t size;
+        };
+
+        struct Event {
+            /**
+             * Position in the trace file, see LocalWriter::beginEvent.
+             */
+            uint64_t key;
+
+            std::string data;
+            std::vector<Signature> signatures;
+            std::vector<BlobRange> blobs;
+        };
+
+        /**
+         * Number of the thread whose event is being serialized.
+         */
+        unsigned thread_id;
+
+        /**
+         * Event being serialized, if any.
+         */
+        Event *event;
+
+        /**
+         * Key of the event being serialized, or ~0 when idle.
+         */
+        uint64_t busyKey;
+
+        ThreadWriter();
+
+        void writeBlob(const void *data, size_t size);
+
+    protected:
+        size_t signatureBegin;
+
+        void beginSignature(void);
+        void endSignature(SignatureKind kind, unsigned id);
+    };
+
+    /**
+     * Writer lent to the current thread, valid between beginEnter/endEnter
+     * and beginLeave/endLeave.
+     */
+    extern OS_THREAD_SPECIFIC_PTR(ThreadWriter) threadWriter;
+
     /**
      * A specialized Writer class, mean to trace the current process.
      *
      * In particular:
      * - it creates a trace file based on the current process name
-     * - uses mutexes to allow tracing from multiple threades
+     * - serializes the calls of each thread into separate buffers, which a
+     *   background thread merges into the trace file in call order, so that
+     *   threads don't have to wait on each other while serializing
      * - flushes the output to ensure the last call is traced in event of
      *   abnormal termination
+     *
+     * The Writer base is not public, as its methods would write into the
+     * trace file directly, bypassing the threads' writers.
      */
-    class LocalWriter : public Writer {
+    class LocalWriter : protected Writer {
     protected:
         /**
-         * This mutex guarantees that only one thread writes to the trace file
-         * at one given instance.
-         *
-         * We need a recursive mutex so that we dont't dead lock in the event
-         * of a segfault happens while the mutex is held.
-         *
-         * To prevent deadlocks, the call for the real function (the one being
-         * traced) should not be done with the mutex held. That is, it should
-         * be done outside the beginEnter/endEnter and beginLeave/endLeave
-         * pairs. Preferably between these two pairs.
+         * State shared with the background thread, including its mutexes.
+         * It is allocated separately, as forked child processes must abandon
+         * it.
+         */
+        struct Queue;
+        Queue *queue;
+
+        /**
+         * Whether the trace file is being written, to avoid writing it again
+         * in the event of a segfault while doing so.
          */
-        os::recursive_mutex mutex;
         int acquired;
 
         /**
@@ -77,6 +155,16 @@ namespace trace {
 
         void checkProcessId();
 
+        unsigned beginEvent(bool enter);
+        void endEvent(void);
+
+        uint64_t getMaxKey(void);
+        bool writeEvents(void);
+        void writeEvent(const ThreadWriter::Event *event);
+        size_t writeBlobs(const ThreadWriter::Event *event, size_t pos, size_t &j, size_t end);
+
+        static void writerThread(LocalWriter *writer);
+
     public:
         /**
          * Should never called directly -- use localWriter singleton below
@@ -88,24 +176,50 @@ namespace trace {
         void open(void);
 
         /**
-         * It will acquire the mutex.
+         * To prevent deadlocks, the call for the real function (the one
+         * being traced) should not be done between beginEnter/endEnter or
+         * beginLeave/endLeave, but preferably between these two pairs.
          */
         unsigned beginEnter(const FunctionSig *sig, bool fake = false);
-
-        /**
-         * It will release the mutex.
-         */
         void endEnter(void);
 
-        /**
-         * It will acquire the mutex.
-         */
         void beginLeave(unsigned call);
+        void endLeave(void);
 
-        /**
-         * It will release the mutex.
+        /*
+         * Everything else is serialized by the thread's own writer.
          */
-        void endLeave(void);
+
+        using Writer::endArg;
+        using Writer::endReturn;
+        using Writer::endBacktrace;
+        using Writer::endArray;
+        using Writer::beginElement;
+        using Writer::endElement;
+        using Writer::endStruct;
+        using Writer::endRepr;
+
+        inline void beginArg(unsigned index) { threadWriter->beginArg(index); }
+        inline void beginReturn(void) { threadWriter->beginReturn(); }
+        inline void beginBacktrace(unsigned num_frames) { threadWriter->beginBacktrace(num_frames); }
+        inline void writeStackFrame(const RawStackFrame *frame) { threadWriter->writeStackFrame(frame); }
+        inline void beginArray(size_t length) { threadWriter->beginArray(length); }
+        inline void beginStruct(const StructSig *sig) { threadWriter->beginStruct(sig); }
+        inline void beginRepr(void) { threadWriter->beginRepr(); }
+        inline void writeBool(bool value) { threadWriter->writeBool(value); }
+        inline void writeSInt(signed long long value) { threadWriter->writeSInt(value); }
+        inline void writeUInt(unsigned long long value) { threadWriter->writeUInt(value); }
+        inline void writeFloat(float value) { threadWriter->writeFloat(value); }
+        inline void writeDouble(double value) { threadWriter->writeDouble(value); }
+        inline void writeString(const char *str) { threadWriter->writeString(str); }
+        inline void writeString(const char *str, size_t size) { threadWriter->writeString(str, size); }
+        inline void writeWString(const wchar_t *str) { threadWriter->writeWString(str); }
+        inline void writeWString(const wchar_t *str, size_t size) { threadWriter->writeWString(str, size); }
+        inline void writeBlob(const void *data, size_t size) { threadWriter->writeBlob(data, size); }
+        inline void writeEnum(const EnumSig *sig, signed long long value) { threadWriter->writeEnum(sig, value); }
+        inline void writeBitmask(const BitmaskSig *sig, unsigned long long value) { threadWriter->writeBitmask(sig, value); }
+        inline void writeNull(void) { threadWriter->writeNull(); }
+        inline void writePointer(unsigned long long addr) { threadWriter->writePointer(addr); }
 
         void flush(void);
     };
@@ -117,5 +231,24 @@ namespace trace {
 
     void fakeMemcpy(const void *ptr, size_t size);
 
+    /*
+     * Shadow copies of writable memory mappings, kept when the
+     * TRACE_DIFF_MAPS environment variable is set, so that only the
+     * modified regions get traced when the mappings are flushed.
+     *
+     * Mappings whose prior contents are undefined (e.g., invalidated ranges)
+     * must not be shadowed, as the modified bytes might happen to match
+     * them.
+     */
+    bool isShadowingMappings(void);
+    void shadowMapping(const void *ptr, size_t size);
+    void unshadowMapping(const void *ptr, size_t size = 1);
+
+    /**
+     * Same as fakeMemcpy, but only for the regions that differ from the
+     * shadow copy, if any, which gets updated.
+     */
+    void fakeMemcpyModified(const void *ptr, size_t size);
+
 } /* namespace trace */
 
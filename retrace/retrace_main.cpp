@@ -62,6 +62,9 @@ static unsigned snapshotInterval = 0;
 static trace::ParseBookmark lastFrameStart;
 
 static unsigned dumpStateCallNo = ~0;
+static trace::CallSet dumpStateCalls;
+static bool dumpStatePending = false;
+static bool profilingBinary = false;
 
 retrace::Retracer retracer;
 
@@ -250,6 +253,25 @@ retraceCall(trace::Call *call) {
         delete writer;
         exit(0);
     }
+
+    if (!dumpStateCalls.empty()) {
+        if (dumpStateCalls.contains(*call)) {
+            dumpStatePending = true;
+        }
+        if (dumpStatePending && dumper->canDump()) {
+            // Precede each state with a comment containing the call no, so
+            // that the states can be told apart
+            std::cout << "// call " << call->no << "\n";
+            StateWriter *writer = stateWriterFactory(std::cout);
+            dumper->dumpState(*writer);
+            delete writer;
+            std::cout.flush();
+            dumpStatePending = false;
+        }
+        if (!dumpStatePending && call->no >= dumpStateCalls.getLast()) {
+            exit(0);
+        }
+    }
 }
 
 
@@ -600,7 +622,9 @@ mainLoop() {
     float timeInterval = (endTime - startTime) * (1.0 / os::timeFrequency);
 
     if ((retrace::verbosity >= -1) || (retrace::profiling)) {
-        std::cout << 
+        // Keep binary profiles free of text
+        std::ostream &out = retrace::profiling && profilingBinary ? std::cerr : std::cout;
+        out << 
             "Rendered " << frameNo << " frames"
             " in " <<  timeInterval << " secs,"
             " average of " << (frameNo/timeInterval) << " fps\n";
@@ -629,6 +653,7 @@ usage(const char *argv0) {
         "      --pgpu              gpu profiling (gpu times per draw call)\n"
         "      --ppd               pixels drawn profiling (pixels drawn per draw call)\n"
         "      --pmem              memory usage profiling (vsize rss per call)\n"
+        "      --profile-format=FMT profile output format (`text` or `binary`)\n"
         "      --call-nos[=BOOL]   use call numbers in snapshot filenames\n"
         "      --core              use core profile\n"
         "      --db                use a double buffer visual (default)\n"
@@ -642,7 +667,7 @@ usage(const char *argv0) {
         "  -S, --snapshot=CALLSET  calls to snapshot (default is every frame)\n"
         "      --snapshot-interval=N    specify a frame interval when generating snaphots (default is 0)\n"
         "  -v, --verbose           increase output verbosity\n"
-        "  -D, --dump-state=CALL   dump state at specific call no\n"
+        "  -D, --dump-state=CALL   dump state at specific call no, or at each call of a CALLSET\n"
         "      --dump-format=FORMAT dump state format (`json` or `ubjson`)\n"
         "  -w, --wait              waitOnFinish on final frame\n"
         "      --loop[=N]          loop N times (N<0 continuously) replaying final frame.\n"
@@ -667,6 +692,7 @@ enum {
     SINGLETHREAD_OPT,
     SNAPSHOT_INTERVAL_OPT,
     DUMP_FORMAT_OPT,
+    PROFILE_FORMAT_OPT,
 };
 
 const static char *
@@ -690,6 +716,7 @@ longOptions[] = {
     {"pgpu", no_argument, 0, PGPU_OPT},
     {"ppd", no_argument, 0, PPD_OPT},
     {"pmem", no_argument, 0, PMEM_OPT},
+    {"profile-format", required_argument, 0, PROFILE_FORMAT_OPT},
     {"sb", no_argument, 0, SB_OPT},
     {"snapshot-prefix", required_argument, 0, 's'},
     {"snapshot-format", required_argument, 0, SNAPSHOT_FORMAT_OPT},
@@ -736,7 +763,11 @@ int main(int argc, char **argv)
             useCallNos = trace::boolOption(optarg);
             break;
         case 'D':
-            dumpStateCallNo = atoi(optarg);
+            if (strspn(optarg, "0123456789") == strlen(optarg)) {
+                dumpStateCallNo = atoi(optarg);
+            } else {
+                dumpStateCalls.merge(optarg);
+            }
             dumpingState = true;
             retrace::verbosity = -2;
             break;
@@ -866,6 +897,16 @@ int main(int argc, char **argv)
 
             retrace::profilingMemoryUsage = true;
             break;
+        case PROFILE_FORMAT_OPT:
+            if (strcasecmp(optarg, "text") == 0) {
+                profilingBinary = false;
+            } else if (strcasecmp(optarg, "binary") == 0) {
+                profilingBinary = true;
+            } else {
+                std::cerr << "error: unsupported profile format `" << optarg << "`\n";
+                return EXIT_FAILURE;
+            }
+            break;
         default:
             std::cerr << "error: unknown option " << opt << "\n";
             usage(argv[0]);
@@ -891,7 +932,10 @@ int main(int argc, char **argv)
 
     retrace::setUp();
     if (retrace::profiling) {
-        retrace::profiler.setup(retrace::profilingCpuTimes, retrace::profilingGpuTimes, retrace::profilingPixelsDrawn, retrace::profilingMemoryUsage);
+        if (profilingBinary) {
+            os::setBinaryMode(stdout);
+        }
+        retrace::profiler.setup(retrace::profilingCpuTimes, retrace::profilingGpuTimes, retrace::profilingPixelsDrawn, retrace::profilingMemoryUsage, profilingBinary);
     }
 
     os::setExceptionCallback(exceptionCallback);
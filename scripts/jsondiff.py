@@ -26,11 +26,21 @@
 ##########################################################################/
 
 
+import base64
+import hashlib
 import json
+import marshal
 import optparse
 import re
 import difflib
+import struct
 import sys
+from cStringIO import StringIO
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 def strip_object_hook(obj):
@@ -42,6 +52,65 @@ def strip_object_hook(obj):
     return obj
 
 
+class HashedObject(dict):
+    '''JSON object, carrying the digest of its contents.'''
+
+    __slots__ = ['digest']
+
+
+class HashedArray(list):
+    '''JSON array, carrying the digest of its contents.'''
+
+    __slots__ = ['digest']
+
+
+def _hash_tree(node):
+    if isinstance(node, dict):
+        result = HashedObject()
+        parts = ['{']
+        for name in sorted(node):
+            value, digest = _hash_tree(node[name])
+            result[name] = value
+            parts.append(marshal.dumps(name))
+            parts.append(digest)
+    elif isinstance(node, list):
+        result = HashedArray()
+        for value in node:
+            if isinstance(value, (dict, list)):
+                break
+        else:
+            # Scalars only, so hash them all at once
+            result.extend(node)
+            result.digest = hashlib.sha1(marshal.dumps(node)).hexdigest()
+            return result, '#' + result.digest
+        parts = ['[']
+        for value in node:
+            value, digest = _hash_tree(value)
+            result.append(value)
+            parts.append(digest)
+    else:
+        return node, marshal.dumps(node)
+    result.digest = hashlib.sha1(''.join(parts)).hexdigest()
+    # Tell digests apart from the marshaled scalars
+    return result, '#' + result.digest
+
+
+def hash_tree(node):
+    '''Return a copy of a JSON tree, whose objects and arrays carry a digest
+    of their contents, so that identical subtrees can be recognized in O(1).
+
+    Worthwhile for trees which are compared many times.'''
+
+    return _hash_tree(node)[0]
+
+
+def _same_digest(a, b):
+    try:
+        return a.digest == b.digest
+    except AttributeError:
+        return False
+
+
 class Visitor:
 
     def visit(self, node, *args, **kwargs):
@@ -137,8 +206,25 @@ class Dumper(Visitor):
 
 
 
+def _is_float_array(values):
+    for value in values:
+        if type(value) is not float:
+            return False
+    return True
+
+
+def _is_number_array(values):
+    for value in values:
+        if type(value) not in (int, long, float):
+            return False
+    return True
+
+
 class Comparer(Visitor):
 
+    # Minimum length of numeric arrays to compare with NumPy
+    min_vector_length = 16
+
     def __init__(self, ignore_added = False, tolerance = 2.0 ** -24):
         self.ignore_added = ignore_added
         self.tolerance = tolerance
@@ -146,6 +232,8 @@ class Comparer(Visitor):
     def visitObject(self, a, b):
         if not isinstance(b, dict):
             return False
+        if _same_digest(a, b) or a == b:
+            return True
         if len(a) != len(b) and not self.ignore_added:
             return False
         ak = a.keys()
@@ -169,11 +257,28 @@ class Comparer(Visitor):
             return False
         if len(a) != len(b):
             return False
+        # Compare in bulk first, and then only the elements which differ
+        if _same_digest(a, b) or a == b:
+            return True
+        if numpy is not None and len(a) >= self.min_vector_length:
+            if _is_float_array(a) and _is_number_array(b) or \
+               _is_float_array(b) and _is_number_array(a):
+                return self.visitFloatArray(a, b)
         for ae, be in zip(a, b):
-            if not self.visit(ae, be):
+            if ae != be and not self.visit(ae, be):
                 return False
         return True
 
+    def visitFloatArray(self, a, b):
+        '''Same as visitValue, for all elements at once.'''
+
+        a = numpy.array(a, dtype=numpy.float64)
+        b = numpy.array(b, dtype=numpy.float64)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            error = numpy.where(a == 0, numpy.abs(b), numpy.abs((b - a)/a))
+            same = (a == b) | (numpy.isnan(a) & numpy.isnan(b)) | (error < self.tolerance)
+        return bool(numpy.all(same))
+
     def visitValue(self, a, b):
         if isinstance(a, float) and isinstance(b, (int, long, float)) or \
            isinstance(b, float) and isinstance(a, (int, long, float)):
@@ -319,22 +424,371 @@ assert _strip_comments('''// a comment
 "'''
 
 
+#
+# State dumps are dominated by base64 encoded images, which are discarded by
+# strip_object_hook anyway, so skip them while reading, without ever holding
+# them in memory
+#
+
+_special_member_re = re.compile(r'^[ \t]*"__\w+__"[ \t]*:[ \t]*"', re.MULTILINE)
+
+
+def _find_string_end(data, pos):
+    '''Find the end of the string whose tail starts at pos, or return -1.'''
+
+    end = data.find('"', pos)
+    while end >= 0:
+        # Count the preceding backslashes
+        start = end
+        while start > pos and data[start - 1] == '\\':
+            start -= 1
+        if (end - start) % 2 == 0:
+            return end + 1
+        end = data.find('"', end + 1)
+    return -1
+
+
+def _read_stripped(stream, chunk_size = 1024*1024):
+    '''Read JSON, replacing the string values of special `__name__` members
+    with null, chunk by chunk.'''
+
+    pieces = []
+    data = ''
+    pos = 0
+    while True:
+        mo = _special_member_re.search(data, pos)
+        if mo is None:
+            # Hold on to the last line, which might be an incomplete match,
+            # unless it is too long for that
+            eol = data.rfind('\n', pos) + 1
+            if eol > pos:
+                pieces.append(data[pos:eol])
+                pos = eol
+            if len(data) - pos > 256:
+                pieces.append(data[pos:])
+                pos = len(data)
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                pieces.append(data[pos:])
+                break
+            if pos > 0:
+                # Keep the preceding character, so that ^ only matches at
+                # line starts
+                data = data[pos - 1:] + chunk
+                pos = 1
+            else:
+                data += chunk
+            continue
+
+        pieces.append(data[pos:mo.end() - 1])
+        pieces.append('null')
+
+        # Skip the string, which may span many chunks
+        pos = mo.end()
+        while True:
+            end = _find_string_end(data, pos)
+            if end >= 0:
+                pos = end
+                break
+            # Carry over any trailing backslashes, as they might escape
+            # the first character of the next chunk
+            start = len(data)
+            while start > pos and data[start - 1] == '\\':
+                start -= 1
+            chunk = stream.read(chunk_size)
+            data = data[start:] + chunk
+            pos = 0
+            if not chunk:
+                break
+
+    return ''.join(pieces)
+
+
+assert _read_stripped(StringIO('''{
+  "__class__": "image",
+  "__data__": "AAAAAAAAAA\\"\\\\AAAAAAAAAAAAAAAAAAAAAAAA",
+  "a": "__b__"
+}'''), 24) == '''{
+  "__class__": null,
+  "__data__": null,
+  "a": "__b__"
+}'''
+
+
+#
+# UBJSON, as written by retrace --dump-format=ubjson
+#
+# See http://ubjson.org/type-reference/
+#
+
+_ubjson_structs = {
+    'i': struct.Struct('>b'),
+    'U': struct.Struct('>B'),
+    'I': struct.Struct('>h'),
+    'l': struct.Struct('>i'),
+    'L': struct.Struct('>q'),
+    'd': struct.Struct('>f'),
+    'D': struct.Struct('>d'),
+}
+
+_ubjson_constants = {
+    'Z': None,
+    'T': True,
+    'F': False,
+}
+
+
+class UBJSONReader:
+    '''Read UBJSON documents from a stream, into the same objects as
+    json.load.
+
+    Strongly typed arrays are read in bulk, and uint8 ones (binary data, such
+    as images) become base64 strings, like in JSON dumps.  When stripping
+    images, objects with a `__class__` member and special `__name__`
+    members are skipped while reading, without decoding them.
+    '''
+
+    def __init__(self, stream, strip_images = True, chunk_size = 1024*1024):
+        self.stream = stream
+        self.strip_images = strip_images
+        self.chunk_size = chunk_size
+        self.data = ''
+        self.pos = 0
+
+    def _fill(self, size):
+        '''Buffer at least size bytes, returning False on EOF.'''
+
+        while len(self.data) - self.pos < size:
+            chunk = self.stream.read(max(self.chunk_size, size))
+            if not chunk:
+                return False
+            self.data = self.data[self.pos:] + chunk
+            self.pos = 0
+        return True
+
+    def _read(self, size):
+        if not self._fill(size):
+            raise ValueError('unexpected end of UBJSON data')
+        pos = self.pos
+        self.pos = pos + size
+        return self.data[pos:self.pos]
+
+    def _skip(self, size):
+        available = len(self.data) - self.pos
+        if size <= available:
+            self.pos += size
+            return
+        size -= available
+        self.data = ''
+        self.pos = 0
+        while size > 0:
+            chunk = self.stream.read(min(size, self.chunk_size))
+            if not chunk:
+                raise ValueError('unexpected end of UBJSON data')
+            size -= len(chunk)
+
+    def _peek(self):
+        if not self._fill(1):
+            raise ValueError('unexpected end of UBJSON data')
+        return self.data[self.pos]
+
+    def _unpack(self, marker):
+        s = _ubjson_structs[marker]
+        if not self._fill(s.size):
+            raise ValueError('unexpected end of UBJSON data')
+        value, = s.unpack_from(self.data, self.pos)
+        self.pos += s.size
+        return value
+
+    def readline(self):
+        '''Read a text line in between documents.'''
+
+        while True:
+            eol = self.data.find('\n', self.pos)
+            if eol >= 0:
+                break
+            if not self._fill(len(self.data) - self.pos + 1):
+                eol = len(self.data) - 1
+                break
+        line = self.data[self.pos:eol + 1]
+        self.pos = eol + 1
+        return line
+
+    def read(self):
+        '''Read the next document.'''
+
+        return self._readValue(self._read(1))
+
+    def _readLength(self):
+        length = self._unpack(self._read(1))
+        if length < 0:
+            raise ValueError('invalid UBJSON length %d' % length)
+        return length
+
+    def _readString(self):
+        return self._read(self._readLength()).decode('utf-8')
+
+    def _readValue(self, marker):
+        if marker in _ubjson_structs:
+            return self._unpack(marker)
+        if marker in _ubjson_constants:
+            return _ubjson_constants[marker]
+        if marker == 'S':
+            return self._readString()
+        if marker == 'C':
+            return self._read(1).decode('utf-8')
+        if marker == 'H':
+            return json.loads(self._read(self._readLength()))
+        if marker == '[':
+            return self._readArray()
+        if marker == '{':
+            return self._readObject()
+        if marker == 'N':
+            return self._readValue(self._read(1))
+        raise ValueError('unexpected UBJSON marker %r' % marker)
+
+    def _readContainerHeader(self):
+        marker = None
+        count = None
+        if self._peek() == '$':
+            self._skip(1)
+            marker = self._read(1)
+            if self._read(1) != '#':
+                raise ValueError('expected UBJSON count')
+            count = self._readLength()
+        elif self._peek() == '#':
+            self._skip(1)
+            count = self._readLength()
+        return marker, count
+
+    def _readArray(self):
+        marker, count = self._readContainerHeader()
+        if marker == 'U':
+            return base64.b64encode(self._read(count)).decode('ascii')
+        if marker in _ubjson_structs:
+            s = _ubjson_structs[marker]
+            return list(struct.unpack('>%u%s' % (count, s.format[1:]), self._read(count*s.size)))
+        if marker in _ubjson_constants:
+            return [_ubjson_constants[marker]]*count
+
+        array = []
+        if count is None:
+            while True:
+                marker = self._read(1)
+                if marker == ']':
+                    break
+                if marker != 'N':
+                    array.append(self._readValue(marker))
+        else:
+            for i in xrange(count):
+                array.append(self._readValue(marker or self._read(1)))
+        return array
+
+    def _readObject(self):
+        marker, count = self._readContainerHeader()
+        obj = {}
+        discard = False
+        i = 0
+        while count is None or i < count:
+            if count is None:
+                c = self._peek()
+                if c == '}':
+                    self._skip(1)
+                    break
+                if c == 'N':
+                    self._skip(1)
+                    continue
+            i += 1
+            name = self._readString()
+            valueMarker = marker or self._read(1)
+            if discard or (self.strip_images and name.startswith('__') and name.endswith('__')):
+                # Like strip_object_hook
+                if name == '__class__':
+                    discard = True
+                self._skipValue(valueMarker)
+            else:
+                obj[name] = self._readValue(valueMarker)
+        if discard:
+            return None
+        return obj
+
+    def _skipValue(self, marker):
+        if marker in _ubjson_structs:
+            self._skip(_ubjson_structs[marker].size)
+        elif marker in _ubjson_constants or marker == 'N':
+            pass
+        elif marker == 'C':
+            self._skip(1)
+        elif marker in ('S', 'H'):
+            self._skip(self._readLength())
+        elif marker == '[':
+            marker, count = self._readContainerHeader()
+            if marker in _ubjson_structs:
+                self._skip(count*_ubjson_structs[marker].size)
+            elif count is None:
+                while True:
+                    marker = self._read(1)
+                    if marker == ']':
+                        break
+                    self._skipValue(marker)
+            else:
+                for i in xrange(count):
+                    self._skipValue(marker or self._read(1))
+        elif marker == '{':
+            marker, count = self._readContainerHeader()
+            i = 0
+            while count is None or i < count:
+                if count is None and self._peek() == '}':
+                    self._skip(1)
+                    break
+                i += 1
+                self._skip(self._readLength())
+                self._skipValue(marker or self._read(1))
+        else:
+            raise ValueError('unexpected UBJSON marker %r' % marker)
+
+
+def load_ubjson(stream, strip_images = True):
+    return UBJSONReader(stream, strip_images).read()
+
+
+def is_ubjson(header):
+    '''Tell UBJSON from JSON, given the first two bytes.'''
+
+    return header[:1] == '{' and header[1:2] in ('i', 'U', 'I', 'l', 'L', '$', '#', '}')
+
+
 def load(stream, strip_images = True, strip_comments = True):
     if strip_images:
         object_hook = strip_object_hook
+        data = _read_stripped(stream)
     else:
         object_hook = None
-    if strip_comments:
+        if not strip_comments:
+            return json.load(stream, strict=False, object_hook = object_hook)
         data = stream.read()
+    if strip_comments:
         data = _strip_comments(data)
-        return json.loads(data, strict=False, object_hook = object_hook)
-    else:
-        return json.load(stream, strict=False, object_hook = object_hook)
+    return json.loads(data, strict=False, object_hook = object_hook)
+
+
+def load_file(filename, strip_images = True):
+    '''Load a JSON or UBJSON file.'''
+
+    stream = open(filename, 'rb')
+    try:
+        if is_ubjson(stream.read(2)):
+            stream.seek(0)
+            return load_ubjson(stream, strip_images)
+        stream.seek(0)
+        return load(stream, strip_images)
+    finally:
+        stream.close()
 
 
 def main():
     optparser = optparse.OptionParser(
-        usage="\n\t%prog [options] <ref_json> <src_json>")
+        usage="\n\t%prog [options] <ref_json> <src_json>\n\nBoth JSON and UBJSON state dumps are accepted.")
     optparser.add_option(
         '--ignore-added',
         action="store_true", dest="ignore_added", default=False,
@@ -349,8 +803,8 @@ def main():
     if len(args) != 2:
         optparser.error('incorrect number of arguments')
 
-    a = load(open(args[0], 'rt'), options.strip_images)
-    b = load(open(args[1], 'rt'), options.strip_images)
+    a = load_file(args[0], options.strip_images)
+    b = load_file(args[1], options.strip_images)
 
     if False:
         dumper = Dumper()
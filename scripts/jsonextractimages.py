@@ -28,52 +28,213 @@
 '''Simple script to extract PNG files from the JSON state dumps.'''
 
 
+import base64
+import collections
+import fnmatch
 import json
 import optparse
-import base64
+import re
 import sys
+from multiprocessing.pool import ThreadPool
+
+import jsondiff
 
 
 pngSignature = "\x89\x50\x4E\x47\x0D\x0A\x1A\x0A"
 
 
+def writeImage(imageName, data):
+    '''Decode a base64 encoded image, and write it with the extension of its
+    format, returning the written file name, or None.'''
+
+    data = base64.b64decode(data)
+
+    if data.startswith(pngSignature):
+        extName = 'png'
+    else:
+        magic = data[:2]
+        if magic in ('P1', 'P4'):
+            extName = 'pbm'
+        elif magic in ('P2', 'P5'):
+            extName = 'pgm'
+        elif magic in ('P3', 'P6'):
+            extName = 'ppm'
+        elif magic in ('Pf', 'PF'):
+            extName = 'pfm'
+        else:
+            sys.stderr.write('warning: unsupport Netpbm format %s\n' % magic)
+            return None
+
+    imageName = '%s.%s' % (imageName, extName)
+    open(imageName, 'wb').write(data)
+    return imageName
+
+
 def dumpSurfaces(state, memberName):
-    for name, imageObj in state[memberName].iteritems():
-        data = imageObj['__data__']
-        data = base64.b64decode(data)
+    '''Generate (name, data) for the images of a state tree.'''
 
-        if data.startswith(pngSignature):
-            extName = 'png'
-        else:
-            magic = data[:2]
-            if magic in ('P1', 'P4'):
-                extName = 'pbm'
-            elif magic in ('P2', 'P5'):
-                extName = 'pgm'
-            elif magic in ('P3', 'P6'):
-                extName = 'ppm'
-            elif magic in ('Pf', 'PF'):
-                extName = 'pfm'
+    for name, imageObj in state.get(memberName, {}).iteritems():
+        yield name, imageObj['__data__']
+
+
+#
+# The JSON writer puts every member in its own line, indented by two spaces
+# per nesting level, so the image names can be tracked without parsing, and
+# the base64 data, which dominates state dumps, skipped with str.find.
+#
+# Multiple state dumps are preceded by a `// call NNN` line.
+#
+
+_line_re = re.compile(r'^(?:// call (\d+)$|( *)"((?:[^"\\\n]|\\.)*)": (")?)', re.MULTILINE)
+
+
+def iterImages(stream, memberNames, chunkSize = 1024*1024):
+    '''Generate (callNo, memberName, name, data) for each image in the given
+    members of a JSON state dump, without building the JSON tree.  callNo is
+    None unless the dump holds multiple states.'''
+
+    callNo = None
+    path = {}
+    data = ''
+    pos = 0
+    eof = False
+    while True:
+        mo = _line_re.search(data, pos)
+
+        # The string quote after the member name might not have been read yet
+        if mo is None or (mo.end() >= len(data) and not eof):
+            if eof:
+                break
+            if mo is None:
+                # Hold on to the last line, which might be an incomplete
+                # match, unless it is too long for that
+                start = data.rfind('\n', pos) + 1
+                if start <= pos:
+                    start = pos
+                if len(data) - start > 256:
+                    start = len(data)
+            else:
+                start = mo.start()
+            chunk = stream.read(chunkSize)
+            if not chunk:
+                eof = True
+            if start > 0:
+                # Keep the preceding character, so that ^ only matches at
+                # line starts
+                data = data[start - 1:] + chunk
+                pos = 1
             else:
-                sys.stderr.write('warning: unsupport Netpbm format %s\n' % magic)
+                data = data[start:] + chunk
+                pos = 0
+            continue
+
+        pos = mo.end()
+
+        if mo.group(1) is not None:
+            callNo = int(mo.group(1))
+            path = {}
+            continue
+
+        level = len(mo.group(2)) // 2
+        name = json.loads('"%s"' % mo.group(3))
+        path[level] = name
+        for deeper in [key for key in path if key > level]:
+            del path[deeper]
+
+        if name != '__data__' or not mo.group(4) or path.get(1) not in memberNames or level < 3:
+            continue
+
+        # Gather the base64 data, which may span many chunks, but has no
+        # escapes
+        pieces = []
+        while True:
+            end = data.find('"', pos)
+            if end >= 0:
+                pieces.append(data[pos:end])
+                pos = end + 1
+                break
+            pieces.append(data[pos:])
+            data = stream.read(chunkSize)
+            pos = 0
+            if not data:
+                eof = True
+                break
+
+        yield callNo, path[1], path[level - 1], ''.join(pieces)
+
+
+def extractImages(images, jobs, patterns):
+    '''Write the images given by (callNo, memberName, name, data) tuples,
+    decoding and writing up to jobs images concurrently.'''
+
+    if jobs > 1:
+        pool = ThreadPool(jobs)
+    else:
+        pool = None
+    pending = collections.deque()
+    try:
+        for callNo, memberName, name, data in images:
+            if patterns and not [pattern for pattern in patterns if fnmatch.fnmatchcase(name, pattern)]:
                 continue
 
-        imageName = '%s.%s' % (name, extName)
-        open(imageName, 'wb').write(data)
-        sys.stderr.write('Wrote %s\n' % imageName)
+            if callNo is None:
+                imageName = name
+            else:
+                imageName = '%u-%s' % (callNo, name)
+
+            if pool is None:
+                imageName = writeImage(imageName, data)
+                if imageName is not None:
+                    sys.stderr.write('Wrote %s\n' % imageName)
+                continue
+
+            pending.append(pool.apply_async(writeImage, (imageName, data)))
+            del data
+            while len(pending) >= jobs:
+                imageName = pending.popleft().get()
+                if imageName is not None:
+                    sys.stderr.write('Wrote %s\n' % imageName)
+
+        while pending:
+            imageName = pending.popleft().get()
+            if imageName is not None:
+                sys.stderr.write('Wrote %s\n' % imageName)
+    finally:
+        if pool is not None:
+            pool.terminate()
 
 
 def main():
     optparser = optparse.OptionParser(
         usage="\n\t%prog [options] <json>")
+    optparser.add_option(
+        '-n', '--name', metavar='PATTERN',
+        type='string', dest='patterns', action='append', default=[],
+        help='only extract the textures/framebuffers whose name matches the glob pattern, which can be given several times')
+    optparser.add_option(
+        '-m', '--member', metavar='MEMBER',
+        type='choice', choices=['textures', 'framebuffer'], dest='members', action='append', default=[],
+        help='only extract `textures` or `framebuffer` images')
+    optparser.add_option(
+        '-j', '--jobs', metavar='NUMBER',
+        type='int', dest='jobs', default=4,
+        help='number of images to decode and write concurrently [default: %default]')
 
     (options, args) = optparser.parse_args(sys.argv[1:])
 
-    for arg in args:
-        state = json.load(open(arg, 'rt'), strict=False)
+    memberNames = options.members or ['textures', 'framebuffer']
 
-        dumpSurfaces(state, 'textures')
-        dumpSurfaces(state, 'framebuffer')
+    for arg in args:
+        stream = open(arg, 'rb')
+        if jsondiff.is_ubjson(stream.read(2)):
+            # UBJSON dumps are still loaded whole
+            stream.seek(0)
+            state = jsondiff.load_ubjson(stream, strip_images=False)
+            images = [(None, memberName, name, data) for memberName in memberNames for name, data in dumpSurfaces(state, memberName)]
+        else:
+            stream.seek(0)
+            images = iterImages(stream, memberNames)
+        extractImages(images, options.jobs, options.patterns)
 
 
 
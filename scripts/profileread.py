@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+##########################################################################
+#
+# Copyright 2012-2013 VMware, Inc.
+# All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+##########################################################################/
+
+'''Read binary profiles, as written by `glretrace --profile-format=binary`.
+
+The profile starts with a text line such as
+
+  # binary type no program name gpu_start gpu_dura
+
+describing the fields of the fixed size records that follow: a type char, the
+call number, program and name id as little-endian uint32, and then the
+enabled values as little-endian int64.  Record types are:
+
+  'c'  a call
+  'f'  the end of a frame
+  'n'  the definition of name id `no`, made of `name` chars, which are stored
+       after the type char of the 'd' records that immediately follow.
+'''
+
+
+import optparse
+import os
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# All value fields, in the order they appear in the text profiles
+valueFields = [
+    'gpu_start', 'gpu_dura',
+    'cpu_start', 'cpu_dura',
+    'vsize_start', 'vsize_dura',
+    'rss_start', 'rss_dura',
+    'pixels',
+]
+
+
+def is_binary(header):
+    return header.startswith('# binary ')
+
+
+class Profile:
+    '''Binary profile, exposing the records as NumPy structured arrays.
+
+    The file is memory mapped when possible, so that only the parts that
+    are actually used get read.
+    '''
+
+    def __init__(self, stream, header=None):
+        if numpy is None:
+            raise Exception('NumPy is required to read binary profiles')
+
+        if header is None:
+            header = stream.readline()
+        if not is_binary(header):
+            raise Exception('not a binary profile')
+
+        self.fields = header.split()[2:]
+        assert self.fields[:4] == ['type', 'no', 'program', 'name']
+        self.valueFields = self.fields[4:]
+
+        self.dtype = numpy.dtype(
+            [('type', 'S1'), ('no', '<u4'), ('program', '<u4'), ('name', '<u4')] +
+            [(field, '<i8') for field in self.valueFields]
+        )
+
+        self.records = self._map(stream)
+
+        types = self.records['type']
+        self._isCall = types == 'c'
+        self.names = self._readNames(types)
+
+    def _map(self, stream):
+        records = self._mapAll(stream)
+
+        # Stop at anything else glretrace might have written to the output,
+        # including calls with names yet to be defined
+        types = records['type']
+        valid = numpy.in1d(types, numpy.array(['c', 'f', 'n', 'd'], dtype='S1'))
+        isCall = types == 'c'
+        valid &= ~isCall | (records['name'] < numpy.cumsum(types == 'n'))
+        invalid = numpy.flatnonzero(~valid)
+        if len(invalid):
+            records = records[:invalid[0]]
+        return records
+
+    def _mapAll(self, stream):
+        # A truncated trailing record, as left by a crash, is ignored
+        itemsize = self.dtype.itemsize
+        try:
+            offset = stream.tell()
+            size = os.fstat(stream.fileno()).st_size
+            count = (size - offset) // itemsize
+            if count <= 0:
+                return numpy.zeros(0, dtype=self.dtype)
+            return numpy.memmap(stream, dtype=self.dtype, mode='r', offset=offset, shape=(count,))
+        except (AttributeError, EnvironmentError, ValueError):
+            # Pipes can't be mapped, nor told, so read the rest of them
+            data = stream.read()
+            count = len(data) // itemsize
+            return numpy.frombuffer(data, dtype=self.dtype, count=count)
+
+    def _readNames(self, types):
+        itemsize = self.dtype.itemsize
+        raw = self.records.view(numpy.uint8).reshape((len(self.records), itemsize))
+
+        names = []
+        for index in numpy.flatnonzero(types == 'n'):
+            record = self.records[index]
+            nameId = int(record['no'])
+            length = int(record['name'])
+            count = (length + itemsize - 2) // (itemsize - 1)
+            name = raw[index + 1 : index + 1 + count, 1:].tostring()[:length]
+            if nameId >= len(names):
+                names.extend([''] * (nameId + 1 - len(names)))
+            names[nameId] = name
+        return names
+
+    def getCalls(self, start=0, stop=None):
+        '''Structured array with the calls among records[start:stop].'''
+
+        return self.records[start:stop][self._isCall[start:stop]]
+
+    def iterCalls(self, chunkSize=1024*1024):
+        '''Generate the calls in chunks of (at most) chunkSize records, so
+        that huge profiles are processed in bounded memory.'''
+
+        for calls, frameEnds in self.iterChunks(chunkSize):
+            yield calls
+
+    def iterChunks(self, chunkSize=1024*1024):
+        '''Same as iterCalls, but also generating the indices, into each
+        chunk of calls, where frames end.'''
+
+        for start in xrange(0, len(self.records), chunkSize):
+            stop = start + chunkSize
+            isCall = self._isCall[start:stop]
+            framePositions = numpy.flatnonzero(self.records['type'][start:stop] == 'f')
+            frameEnds = numpy.cumsum(isCall)[framePositions] if len(framePositions) else []
+            yield self.records[start:stop][isCall], list(frameEnds)
+
+    calls = property(getCalls)
+
+    def getNames(self, nameIds):
+        '''Map an array of name ids to an array of names.'''
+
+        names = numpy.array(self.names + [''])
+        return names[numpy.minimum(nameIds, len(self.names))]
+
+    def getFrames(self):
+        '''Structured array with, for each frame, the [begin, end) range of
+        its calls' indices, and the total of each duration field.'''
+
+        callCount = numpy.cumsum(self._isCall)
+        ends = callCount[numpy.flatnonzero(self.records['type'] == 'f')]
+        begins = numpy.concatenate(([0], ends[:-1]))
+
+        durationFields = [field for field in self.valueFields if field.endswith('_dura')]
+        dtype = [('no', '<u4'), ('begin', '<u4'), ('end', '<u4')]
+        dtype += [(field, '<i8') for field in durationFields]
+        frames = numpy.zeros(len(ends), dtype=dtype)
+        frames['no'] = numpy.arange(len(ends))
+        frames['begin'] = begins
+        frames['end'] = ends
+
+        calls = self.calls
+        for field in durationFields:
+            totals = numpy.concatenate(([0], numpy.cumsum(calls[field])))
+            frames[field] = totals[ends] - totals[begins]
+        return frames
+
+    frames = property(getFrames)
+
+    def getPrograms(self):
+        '''Structured array with, for each program, the number of calls and
+        the total of each duration field and of pixels.'''
+
+        calls = self.calls
+        programs = calls['program']
+        numPrograms = int(programs.max()) + 1 if len(programs) else 0
+
+        totalFields = [field for field in self.valueFields if field.endswith('_dura') or field == 'pixels']
+        dtype = [('program', '<u4'), ('calls', '<i8')]
+        dtype += [(field, '<i8') for field in totalFields]
+        result = numpy.zeros(numPrograms, dtype=dtype)
+        result['program'] = numpy.arange(numPrograms)
+        result['calls'] = numpy.bincount(programs, minlength=numPrograms)
+        for field in totalFields:
+            result[field] = numpy.bincount(programs, weights=calls[field], minlength=numPrograms)
+        return result
+
+    programs = property(getPrograms)
+
+    def writeText(self, stream):
+        '''Write the profile in the text format, for the tools that only
+        understand it.'''
+
+        stream.write('# call no %s program name\n' % ' '.join(valueFields))
+        isFrameEnd = self.records['type'] == 'f'
+        frameEnds = numpy.flatnonzero(isFrameEnd)
+        start = 0
+        for stop in list(frameEnds) + [len(self.records)]:
+            calls = self.getCalls(start, stop)
+            columns = [calls['no']]
+            for field in valueFields:
+                if field in self.valueFields:
+                    columns.append(calls[field])
+                else:
+                    columns.append(numpy.zeros(len(calls), dtype=numpy.int64))
+            columns.append(calls['program'])
+            names = self.getNames(calls['name'])
+            for row in zip(*(columns + [names])):
+                stream.write('call %s\n' % ' '.join(map(str, row)))
+            if stop < len(self.records):
+                stream.write('frame_end\n')
+            start = stop + 1
+
+
+def main():
+    optparser = optparse.OptionParser(
+        usage='\n\t%prog [options] <profile_input>',
+        version='%%prog')
+    (options, args) = optparser.parse_args(sys.argv[1:])
+
+    if len(args) > 1:
+        optparser.error('incorrect number of arguments')
+
+    if args:
+        stream = open(args[0], 'rb')
+    else:
+        stream = sys.stdin
+
+    profile = Profile(stream)
+    profile.writeText(sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
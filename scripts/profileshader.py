@@ -25,78 +25,572 @@
 ##########################################################################/
 
 
+import itertools
+import math
 import optparse
 import sys
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-def process(stream, groupField):
-    times = {}
+import profileread
 
-    # Read header describing fields
-    header = stream.readline()
-    assert header.startswith('#')
 
-    fields = header.rstrip('\r\n').split(' ')[1:]
-    columns = {}
-    for column in range(len(fields)):
-        columns[fields[column]] = column
+# Durations are also counted in a logarithmic histogram, with this many bins
+# per power of two, so that percentiles can be estimated in constant memory,
+# within about 2%
+binsPerOctave = 32
+numBins = 64*binsPerOctave + 1
 
-    callCol = columns['call']
-    callIdCol = columns['no']
-    gpuDuraCol = columns['gpu_dura']
-    programCol = columns['program']
-    funcNameCol = columns['name']
 
-    groupCol = columns[groupField]
+def durationBin(duration):
+    if duration <= 0:
+        return 0
+    return min(int(math.log(duration, 2)*binsPerOctave) + 1, numBins - 1)
 
-    maxGroupLen = 0
 
-    for line in stream:
-        fields = line.rstrip('\r\n').split(' ')
+def durationBins(durations):
+    '''Same as durationBin, for a NumPy array of durations.'''
 
-        if line.startswith('#'):
-            continue
+    bins = numpy.zeros(len(durations), dtype=numpy.int64)
+    positive = durations > 0
+    bins[positive] = numpy.minimum(numpy.log2(durations[positive])*binsPerOctave + 1, numBins - 1)
+    return bins
+
+
+def binDuration(bin):
+    '''Representative duration of a histogram bin.'''
+
+    if bin == 0:
+        return 0
+    return long(round(2.0 ** ((bin - 0.5)/binsPerOctave)))
+
+
+class Group:
+    '''Statistics of the calls in a group.'''
+
+    def __init__(self):
+        self.draws = 0
+        self.duration = 0
+        self.durationSquares = 0
+        self.longest = None
+        self.longestDuration = -1
+        self.shortestDuration = None
+        if numpy is None:
+            self.histogram = [0]*numBins
+        else:
+            self.histogram = numpy.zeros(numBins, dtype=numpy.int64)
+
+    def add(self, callNo, duration):
+        self.draws += 1
+        self.duration += duration
+        self.durationSquares += duration*duration
+        if duration > self.longestDuration:
+            self.longest = callNo
+            self.longestDuration = duration
+        if self.shortestDuration is None or duration < self.shortestDuration:
+            self.shortestDuration = duration
+        self.histogram[durationBin(duration)] += 1
+
+    def mean(self):
+        return float(self.duration)/self.draws
+
+    def variance(self):
+        if self.draws < 2:
+            return 0.0
+        return max(self.durationSquares - float(self.duration)*self.duration/self.draws, 0.0)/(self.draws - 1)
+
+    def percentile(self, percent):
+        rank = max(int(math.ceil(percent*self.draws/100.0)), 1)
+        count = 0
+        for bin in range(numBins):
+            count += self.histogram[bin]
+            if count >= rank:
+                # The bins are coarse, so keep the estimate within the range
+                return min(max(binDuration(bin), self.shortestDuration), self.longestDuration)
+        return self.longestDuration
+
+
+class Aggregator:
+    '''Aggregates the calls by the value of a field.'''
+
+    def __init__(self, field):
+        self.field = field
+        self.groups = {}
+
+    def add(self, groups, callNos, durations):
+        '''Add a chunk of calls, given as parallel lists of strings, or NumPy
+        arrays.'''
+
+        if numpy is None:
+            for group, callNo, duration in itertools.izip(groups, callNos, durations):
+                try:
+                    stats = self.groups[group]
+                except KeyError:
+                    stats = self.groups[group] = Group()
+                stats.add(long(callNo), long(duration))
+            return
+
+        if isinstance(durations, list):
+            durations = numpy.array(map(int, durations), dtype=numpy.int64)
+        keys, inverse = numpy.unique(numpy.array(groups), return_inverse=True)
+        numKeys = len(keys)
+        draws = numpy.bincount(inverse, minlength=numKeys)
+        sums = numpy.bincount(inverse, weights=durations, minlength=numKeys)
+        squares = numpy.bincount(inverse, weights=durations.astype(numpy.float64)**2, minlength=numKeys)
+        histograms = numpy.bincount(inverse*numBins + durationBins(durations), minlength=numKeys*numBins)
+        histograms = histograms.reshape((numKeys, numBins))
+
+        # Sort by group, duration, and reverse call order, so that the last
+        # call of each group is its first longest one
+        order = numpy.lexsort((-numpy.arange(len(durations)), durations, inverse))
+        first = numpy.searchsorted(inverse[order], numpy.arange(numKeys), side='left')
+        last = numpy.searchsorted(inverse[order], numpy.arange(numKeys), side='right') - 1
+        shortest = order[first]
+        longest = order[last]
+
+        for i in range(numKeys):
+            group = keys[i]
+            try:
+                stats = self.groups[group]
+            except KeyError:
+                stats = self.groups[group] = Group()
+            stats.draws += int(draws[i])
+            stats.duration += long(sums[i])
+            stats.durationSquares += float(squares[i])
+            duration = long(durations[longest[i]])
+            if duration > stats.longestDuration:
+                stats.longest = long(callNos[longest[i]])
+                stats.longestDuration = duration
+            duration = long(durations[shortest[i]])
+            if stats.shortestDuration is None or duration < stats.shortestDuration:
+                stats.shortestDuration = duration
+            stats.histogram += histograms[i]
+
+    def report(self):
+        times = sorted(self.groups.items(), key=lambda x: x[1].duration, reverse=True)
+
+        groupField = self.field
+        if groupField == 'program':
+            groupTitle = 'Shader[id]'
+        else:
+            groupTitle = groupField
+        maxGroupLen = max([len(str(group)) for group in self.groups] + [len(groupTitle)])
+        groupTitle = groupField.center(maxGroupLen)
+        groupLine = '-' * maxGroupLen
+
+        print '+-%s-+--------------+--------------------+--------------+-------------+--------------+--------------+--------------+' % groupLine
+        print '| %s |   Draws [#]  |   Duration [ns]  v | Per Call[ns] | Longest[id] |   p50 [ns]   |   p95 [ns]   |   p99 [ns]   |' % groupTitle
+        print '+-%s-+--------------+--------------------+--------------+-------------+--------------+--------------+--------------+' % groupLine
+
+        for group, stats in times:
+            id = str(group).rjust(maxGroupLen)
+            draw = str(stats.draws).rjust(12)
+            dura = str(stats.duration).rjust(18)
+            perCall = str(stats.duration / stats.draws).rjust(12)
+            longest = str(stats.longest).rjust(11)
+            percentiles = ' | '.join([str(stats.percentile(percent)).rjust(12) for percent in (50, 95, 99)])
+            print "| %s | %s | %s | %s | %s | %s |" % (id, draw, dura, perCall, longest, percentiles)
 
-        if fields[callCol] == 'call':
-            callId = long(fields[callIdCol])
-            duration = long(fields[gpuDuraCol])
-            group = fields[groupCol]
+        print '+-%s-+--------------+--------------------+--------------+-------------+--------------+--------------+--------------+' % groupLine
 
-            maxGroupLen = max(maxGroupLen, len(group))
 
-            if times.has_key(group):
-                times[group]['draws'] += 1
-                times[group]['duration'] += duration
+class FrameStats:
+    '''Distribution of the frame times of a clock.
 
-                if duration > times[group]['longestDuration']:
-                    times[group]['longest'] = callId
-                    times[group]['longestDuration'] = duration
+    As in trace::Profiler::parseLine, a frame lasts from the end of the
+    previous frame to the latest end of its calls.
+    '''
+
+    # Frames this many times longer than the median are stutters
+    stutterFactor = 2.0
+
+    binsPerOctave = 4
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.times = []
+        self.lastTime = 0
+        self.frameStart = 0
+
+    def _advance(self, ends):
+        if len(ends):
+            self.lastTime = max(self.lastTime, long(max(ends)))
+
+    def add(self, ends, frameEnds):
+        '''Add a chunk of calls, given by the times at which they end, and
+        the indices where frames end.'''
+
+        start = 0
+        for stop in frameEnds:
+            self._advance(ends[start:stop])
+            self.times.append(self.lastTime - self.frameStart)
+            self.frameStart = self.lastTime
+            start = stop
+        self._advance(ends[start:])
+
+    def empty(self):
+        return not self.times or not max(self.times)
+
+    def count(self):
+        return len(self.times)
+
+    def mean(self):
+        return float(sum(self.times))/len(self.times)
+
+    def variance(self):
+        if len(self.times) < 2:
+            return 0.0
+        mean = self.mean()
+        return sum([(time - mean)**2 for time in self.times])/(len(self.times) - 1)
+
+    def percentile(self, percent, times=None):
+        if times is None:
+            times = sorted(self.times)
+        rank = max(int(math.ceil(percent*len(times)/100.0)), 1)
+        return times[rank - 1]
+
+    def stutters(self):
+        median = self.percentile(50)
+        return [time for time in self.times if time > self.stutterFactor*median]
+
+    def variation(self):
+        '''Mean difference between consecutive frame times.'''
+
+        if len(self.times) < 2:
+            return 0.0
+        differences = [abs(b - a) for a, b in zip(self.times[:-1], self.times[1:])]
+        return float(sum(differences))/len(differences)
+
+    def histogram(self):
+        bins = {}
+        for time in self.times:
+            if time > 0:
+                bin = int(math.floor(math.log(time, 2)*self.binsPerOctave))
             else:
-                times[group] = {'draws': 1, 'duration': duration, 'longest': callId, 'longestDuration': duration}
+                bin = None
+            bins[bin] = bins.get(bin, 0) + 1
+        return bins
+
+    def binRange(self, bin):
+        if bin is None:
+            return 0, 0
+        return 2.0**(float(bin)/self.binsPerOctave), 2.0**(float(bin + 1)/self.binsPerOctave)
+
+
+def ms(ns):
+    return '%.3f' % (ns*1e-6)
+
+
+def reportFrames(frameStats):
+    frameStats = [stats for stats in frameStats if not stats.empty()]
+    if not frameStats:
+        print 'No frame times'
+        return
+
+    line = '+-------+----------+-------------+-------------+-------------+-------------+-------------+-------------+-------------+--------------+'
+    print line
+    print '| Clock |  Frames  |  Mean [ms]  | Stddev [ms] |  p50 [ms]   |  p95 [ms]   |  p99 [ms]   |  Max [ms]   |  Var. [ms]  | Stutters [%] |'
+    print line
+    for stats in frameStats:
+        times = sorted(stats.times)
+        percentiles = ' | '.join([ms(stats.percentile(percent, times)).rjust(11) for percent in (50, 95, 99)])
+        stutters = 100.0*len(stats.stutters())/stats.count()
+        print '| %s | %s | %s | %s | %s | %s | %s | %s |' % (
+            stats.clock.upper().ljust(5),
+            str(stats.count()).rjust(8),
+            ms(stats.mean()).rjust(11),
+            ms(math.sqrt(stats.variance())).rjust(11),
+            percentiles,
+            ms(times[-1]).rjust(11),
+            ms(stats.variation()).rjust(11),
+            ('%.1f' % stutters).rjust(12),
+        )
+    print line
+    print 'Var. is the mean difference between consecutive frames; stutters are frames over %gx the median.' % FrameStats.stutterFactor
+
+    for stats in frameStats:
+        print
+        print '%s frame time histogram:' % stats.clock.upper()
+        bins = stats.histogram()
+        maxCount = max(bins.values())
+        for bin in sorted(bins):
+            lo, hi = stats.binRange(bin)
+            count = bins[bin]
+            bar = '#' * int(math.ceil(50.0*count/maxCount))
+            print '  %s - %s ms | %s %u' % (ms(lo).rjust(10), ms(hi).rjust(10), bar.ljust(50), count)
+    print
+
+
+##########################################################################
+# Comparison
+
+
+# Minimum number of samples for the normal approximation of the t
+# distribution to hold
+minSamples = 30
+
+
+def welchTest(n1, mean1, variance1, n2, mean2, variance2):
+    '''One-sided Welch's t-test of the second mean being bigger than the
+    first one, returning the p-value.
+
+    The t distribution is approximated by the normal distribution, so it
+    should only be trusted with at least minSamples samples.
+    '''
+
+    error = math.sqrt(variance1/n1 + variance2/n2)
+    if error == 0:
+        if mean2 > mean1:
+            return 0.0
+        else:
+            return 1.0
+    t = (mean2 - mean1)/error
+    return 0.5*math.erfc(t/math.sqrt(2))
+
 
-    times = sorted(times.items(), key=lambda x: x[1]['duration'], reverse=True)
+def compareSamples(name, n1, mean1, variance1, n2, mean2, variance2, threshold, alpha):
+    '''Compare two sets of samples, given by their size, mean and variance.
 
-    if groupField == 'program':
-        groupTitle = 'Shader[id]'
+    A regression is an increase of the mean of more than threshold percent
+    that is statistically significant at the given alpha level.
+    '''
+
+    if mean1:
+        change = 100.0*(mean2 - mean1)/mean1
+    elif mean2:
+        change = float('inf')
+    else:
+        change = 0.0
+
+    if n1 < minSamples or n2 < minSamples:
+        pvalue = None
+        regression = False
     else:
-        groupTitle = groupField
-    maxGroupLen = max(maxGroupLen, len(groupTitle))
-    groupTitle = groupField.center(maxGroupLen)
-    groupLine = '-' * maxGroupLen
+        pvalue = welchTest(n1, mean1, variance1, n2, mean2, variance2)
+        regression = change > threshold and pvalue < alpha
+
+    return name, mean1, mean2, change, pvalue, regression
+
+
+def reportComparison(field, rows, unit='ns'):
+    '''Print the comparison rows, sorted by change, returning whether there
+    were any regressions.'''
+
+    rows.sort(key=lambda row: row[3], reverse=True)
+
+    maxNameLen = max([len(str(row[0])) for row in rows] + [len(field)])
+    nameLine = '-' * maxNameLen
+
+    line = '+-%s-+--------------------+--------------------+------------+-----------+------------+' % nameLine
+    print line
+    print '| %s | %s | %s | Change [%%] |  p-value  |            |' % (
+        field.center(maxNameLen),
+        ('Baseline [%s]' % unit).center(18),
+        ('Profile [%s]' % unit).center(18),
+    )
+    print line
+    regressed = False
+    for name, mean1, mean2, change, pvalue, regression in rows:
+        if pvalue is None:
+            pvalue = 'n/a'
+        else:
+            pvalue = '%.2g' % pvalue
+        if regression:
+            flag = 'REGRESSION'
+            regressed = True
+        else:
+            flag = ''
+        print '| %s | %s | %s | %s | %s | %s |' % (
+            str(name).rjust(maxNameLen),
+            ('%.1f' % mean1).rjust(18),
+            ('%.1f' % mean2).rjust(18),
+            ('%+.1f' % change).rjust(10),
+            pvalue.rjust(9),
+            flag.ljust(10),
+        )
+    print line
+    return regressed
+
+
+def compareGroups(baseline, current, threshold, alpha):
+    '''Compare the mean call durations of the groups of two aggregators,
+    returning whether any regressed.'''
+
+    field = current.field
+    rows = []
+    for group, stats in current.groups.iteritems():
+        try:
+            baseStats = baseline.groups[group]
+        except KeyError:
+            continue
+        rows.append(compareSamples(group,
+                                   baseStats.draws, baseStats.mean(), baseStats.variance(),
+                                   stats.draws, stats.mean(), stats.variance(),
+                                   threshold, alpha))
+
+    print 'Mean call durations by %s, against the baseline:' % field
+    regressed = False
+    if rows:
+        regressed = reportComparison(field, rows)
+
+    added = len([group for group in current.groups if group not in baseline.groups])
+    removed = len([group for group in baseline.groups if group not in current.groups])
+    if added or removed:
+        print '%u %s(s) only in the baseline, %u only in the profile' % (removed, field, added)
+    print
+    return regressed
+
 
-    print '+-%s-+--------------+--------------------+--------------+-------------+' % groupLine
-    print '| %s |   Draws [#]  |   Duration [ns]  v | Per Call[ns] | Longest[id] |' % groupTitle
-    print '+-%s-+--------------+--------------------+--------------+-------------+' % groupLine
+def compareFrames(baseline, current, threshold, alpha):
+    '''Compare the mean frame times of two profiles, returning whether any
+    regressed.'''
 
-    for group in times:
-        id = str(group[0]).rjust(maxGroupLen)
-        draw = str(group[1]['draws']).rjust(12)
-        dura = str(group[1]['duration']).rjust(18)
-        perCall = str(group[1]['duration'] / group[1]['draws']).rjust(12)
-        longest = str(group[1]['longest']).rjust(11)
-        print "| %s | %s | %s | %s | %s |" % (id, draw, dura, perCall, longest)
+    rows = []
+    for baseStats, stats in zip(baseline, current):
+        assert baseStats.clock == stats.clock
+        if baseStats.empty() or stats.empty():
+            continue
+        rows.append(compareSamples(stats.clock.upper(),
+                                   baseStats.count(), baseStats.mean(), baseStats.variance(),
+                                   stats.count(), stats.mean(), stats.variance(),
+                                   threshold, alpha))
+    if not rows:
+        return False
+
+    print 'Mean frame times, against the baseline:'
+    regressed = reportComparison('clock', rows)
+    print
+    return regressed
+
+
+##########################################################################
+# Input
+
+
+def readCalls(stream, numFields, chunkSize = 4*1024*1024):
+    '''Read the profile in big chunks, generating lists with the fields of
+    all the calls in each chunk, and the indices of the calls where frames
+    end.'''
+
+    while True:
+        data = stream.read(chunkSize)
+        if not data:
+            break
+        data += stream.readline()
+        # Skip comments and anything else glretrace prints, such as the frame
+        # rate or errors, unless all lines are calls or frame ends.
+        lines = data.count('\n') + (not data.endswith('\n'))
+        records = ('\n' + data).count('\ncall ') + ('\n' + data).count('\nframe_end')
+        if records != lines:
+            data = ''.join([line for line in data.splitlines(True) if line.startswith('call ') or line.startswith('frame_end')])
+        fields = data.split()
+        frameEnds = []
+        if 'frame_end' in data:
+            calls = []
+            start = 0
+            while True:
+                try:
+                    stop = fields.index('frame_end', start)
+                except ValueError:
+                    break
+                calls.extend(fields[start:stop])
+                frameEnds.append(len(calls) // numFields)
+                start = stop + 1
+            calls.extend(fields[start:])
+            fields = calls
+        if len(fields) % numFields:
+            raise Exception('malformed profile')
+        yield fields, frameEnds
 
-    print '+-%s-+--------------+--------------------+--------------+-------------+' % groupLine
+
+def toIntegers(values):
+    if numpy is None:
+        return map(long, values)
+    if isinstance(values, list):
+        return numpy.array(map(int, values), dtype=numpy.int64)
+    return values.astype(numpy.int64)
+
+
+def callEnds(starts, durations):
+    '''Times at which calls end.'''
+
+    starts = toIntegers(starts)
+    durations = toIntegers(durations)
+    if numpy is None:
+        return [start + duration for start, duration in itertools.izip(starts, durations)]
+    return starts + durations
+
+
+def processBinary(stream, header, groupFields, frames):
+    profile = profileread.Profile(stream, header)
+
+    aggregators = [Aggregator(groupField) for groupField in groupFields]
+    frameStats = []
+    if frames:
+        frameStats = [FrameStats(clock) for clock in ('gpu', 'cpu') if clock + '_dura' in profile.valueFields]
+
+    # Only the profiled values are written, so fall back to CPU durations
+    # when there are no GPU ones
+    durationFields = [clock + '_dura' for clock in ('gpu', 'cpu') if clock + '_dura' in profile.valueFields]
+    if not durationFields:
+        raise Exception('profile has no durations')
+    durationField = durationFields[0]
+
+    for calls, frameEnds in profile.iterChunks():
+        callNos = calls['no']
+        durations = calls[durationField]
+        for aggregator in aggregators:
+            if aggregator.field == 'name':
+                groups = profile.getNames(calls['name'])
+            else:
+                # Group by the same strings as text profiles, so that they
+                # can be compared against each other
+                groups = calls[aggregator.field].astype(str)
+            aggregator.add(groups, callNos, durations)
+        for stats in frameStats:
+            ends = callEnds(calls[stats.clock + '_start'], calls[stats.clock + '_dura'])
+            stats.add(ends, frameEnds)
+
+    return aggregators, frameStats
+
+
+def process(stream, groupFields, frames=False):
+    '''Read a profile, returning an aggregator for each group field, and,
+    if frames is set, the frame time statistics of each clock.'''
+
+    # Read header describing fields
+    header = stream.readline()
+    assert header.startswith('#')
+
+    if profileread.is_binary(header):
+        return processBinary(stream, header, groupFields, frames)
+
+    fields = header.rstrip('\r\n').split(' ')[1:]
+    columns = {}
+    for column in range(len(fields)):
+        columns[fields[column]] = column
+    numFields = len(fields)
+
+    callIdCol = columns['no']
+    gpuDuraCol = columns['gpu_dura']
+
+    aggregators = [(Aggregator(groupField), columns[groupField]) for groupField in groupFields]
+    frameStats = []
+    if frames:
+        frameStats = [(FrameStats(clock), columns[clock + '_start'], columns[clock + '_dura']) for clock in ('gpu', 'cpu')]
+
+    for fields, frameEnds in readCalls(stream, numFields):
+        callNos = fields[callIdCol::numFields]
+        durations = fields[gpuDuraCol::numFields]
+        for aggregator, groupCol in aggregators:
+            aggregator.add(fields[groupCol::numFields], callNos, durations)
+        for stats, startCol, duraCol in frameStats:
+            stats.add(callEnds(fields[startCol::numFields], fields[duraCol::numFields]), frameEnds)
+
+    return [aggregator for aggregator, groupCol in aggregators], [stats for stats, startCol, duraCol in frameStats]
 
 
 def main():
@@ -108,16 +602,62 @@ def main():
 
     optparser.add_option(
         '-g', '--group', metavar='FIELD',
-        type="string", dest="group", default='program',
-        help="group by specified field [default: %default]")
-    
+        type="string", dest="group", action="append", default=[],
+        help="group by specified field, which can be given several times [default: program]")
+    optparser.add_option(
+        '-f', '--frames',
+        action="store_true", dest="frames", default=False,
+        help="report the frame time distribution")
+    optparser.add_option(
+        '-c', '--compare', metavar='BASELINE',
+        type="string", dest="baseline", default=None,
+        help="compare against a baseline profile, exiting with 1 on regressions")
+    optparser.add_option(
+        '--threshold', metavar='PERCENT',
+        type="float", dest="threshold", default=5.0,
+        help="minimum mean duration increase to count as a regression [default: %default]")
+    optparser.add_option(
+        '--alpha', metavar='ALPHA',
+        type="float", dest="alpha", default=0.001,
+        help="significance level of regressions [default: %default]")
+
     (options, args) = optparser.parse_args(sys.argv[1:])
 
+    groupFields = []
+    for group in options.group:
+        groupFields.extend(group.split(','))
+    if not groupFields:
+        groupFields = ['program']
+
     if len(args):
-        for arg in args:
-            process(open(arg, 'rt'), options.group)
+        streams = [open(arg, 'rb') for arg in args]
     else:
-        process(sys.stdin, options.group)
+        streams = [sys.stdin]
+
+    if options.baseline is None:
+        for stream in streams:
+            aggregators, frameStats = process(stream, groupFields, options.frames)
+            for aggregator in aggregators:
+                aggregator.report()
+            if options.frames:
+                reportFrames(frameStats)
+        return
+
+    baseAggregators, baseFrameStats = process(open(options.baseline, 'rb'), groupFields, frames=True)
+
+    regressed = False
+    for stream in streams:
+        aggregators, frameStats = process(stream, groupFields, frames=True)
+        if options.frames:
+            reportFrames(frameStats)
+        for baseAggregator, aggregator in zip(baseAggregators, aggregators):
+            if compareGroups(baseAggregator, aggregator, options.threshold, options.alpha):
+                regressed = True
+        if compareFrames(baseFrameStats, frameStats, options.threshold, options.alpha):
+            regressed = True
+
+    if regressed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -28,12 +28,18 @@
 '''
 
 
-import math
+import collections
+import hashlib
+import json
 import optparse
 import os.path
 import subprocess
 import platform
 import sys
+import tempfile
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
 
 from PIL import Image
 
@@ -53,9 +59,35 @@ class RetraceRun:
 
     def __init__(self, process):
         self.process = process
+        self.reader = PnmReader(process.stdout)
+        self.queue = None
+        self.error = None
+
+    def start(self, queueSize, snapshots):
+        '''Read snapshots ahead on a separate thread, queuing up to queueSize
+        of them, and keeping each snapshot valid until the given number of
+        following snapshots are got.'''
+
+        # Besides the queued ones, one snapshot is being read
+        self.reader = PnmReader(self.process.stdout, queueSize + snapshots + 1)
+        self.queue = Queue.Queue(queueSize)
+        thread = threading.Thread(target=self._readSnapshots)
+        thread.daemon = True
+        thread.start()
+
+    def _readSnapshots(self):
+        try:
+            while True:
+                image, callNo = self._readSnapshot()
+                self.queue.put((image, callNo))
+                if image is None:
+                    break
+        except Exception, ex:
+            self.error = ex
+            self.queue.put((None, None))
 
-    def nextSnapshot(self):
-        image, comment = read_pnm(self.process.stdout)
+    def _readSnapshot(self):
+        image, comment = self.reader.read()
         if image is None:
             return None, None
 
@@ -63,6 +95,18 @@ class RetraceRun:
 
         return image, callNo
 
+    def nextSnapshot(self):
+        '''Get the next snapshot, which is only valid until the following
+        call, unless started otherwise.'''
+
+        if self.queue is None:
+            return self._readSnapshot()
+
+        image, callNo = self.queue.get()
+        if self.error is not None:
+            raise self.error
+        return image, callNo
+
     def terminate(self):
         try:
             self.process.terminate()
@@ -71,12 +115,80 @@ class RetraceRun:
             pass
 
 
+class StateCache:
+    '''On-disk cache of state dumps, keyed by the retrace command line, the
+    files it refers to, and the call no.'''
+
+    version = 2
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def getPath(self, retracer, call_no):
+        key = [self.version, retracer.retraceExe, retracer.args]
+        if retracer.env:
+            key.append(sorted(retracer.env.items()))
+        for arg in retracer.args:
+            if os.path.isfile(arg):
+                st = os.stat(arg)
+                key.append((os.path.abspath(arg), st.st_mtime, st.st_size))
+        digest = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self.directory, digest, '%u.json' % call_no)
+
+    def load(self, retracer, call_no):
+        try:
+            stream = open(self.getPath(retracer, call_no), 'rt')
+        except IOError:
+            return None
+        try:
+            return json.load(stream)
+        except ValueError:
+            return None
+        finally:
+            stream.close()
+
+    def store(self, retracer, call_no, state):
+        path = self.getPath(retracer, call_no)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Write to a temporary file first, so that concurrent or interrupted
+        # runs never see incomplete entries
+        fd, tmpPath = tempfile.mkstemp(dir = directory)
+        stream = os.fdopen(fd, 'wt')
+        try:
+            json.dump(state, stream)
+        finally:
+            stream.close()
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmpPath, path)
+
+
+def read_states(stream):
+    '''Read the UBJSON state dumps written by retrace -D CALLSET, generating
+    (call_no, state) tuples.'''
+
+    marker = '// call '
+    reader = jsondiff.UBJSONReader(stream)
+    while True:
+        line = reader.readline()
+        if not line:
+            break
+        assert line.startswith(marker)
+        call_no = int(line[len(marker):])
+        yield call_no, reader.read()
+
+
 class Retracer:
 
-    def __init__(self, retraceExe, args, env=None):
+    def __init__(self, retraceExe, args, env=None, cache=None):
         self.retraceExe = retraceExe
         self.args = args
         self.env = env
+        self.cache = cache
+        self.states = {}
 
     def _retrace(self, args, stdout=subprocess.PIPE):
         cmd = [
@@ -107,18 +219,60 @@ class Retracer:
     def dump_state(self, call_no):
         '''Get the state dump at the specified call no.'''
 
-        p = self._retrace([
-            '-D', str(call_no),
-        ])
-        state = jsondiff.load(p.stdout)
-        p.wait()
-        return state.get('parameters', {})
+        return self.dump_states([call_no])[call_no]
+
+    def dump_states(self, call_nos):
+        '''Get the state dumps at the specified call nos, retracing at most
+        once for all the ones not dumped before.'''
+
+        missing = []
+        for call_no in sorted(set(call_nos)):
+            if call_no in self.states:
+                continue
+            state = None
+            if self.cache is not None:
+                state = self.cache.load(self, call_no)
+            if state is None:
+                missing.append(call_no)
+            else:
+                self.states[call_no] = jsondiff.hash_tree(state)
+
+        if len(missing) == 1:
+            call_no, = missing
+            p = self._retrace([
+                '-D', str(call_no),
+                '--dump-format=ubjson',
+            ])
+            state = jsondiff.load_ubjson(p.stdout)
+            p.wait()
+            self._add_state(call_no, state.get('parameters', {}))
+        elif missing:
+            p = self._retrace([
+                '-D', ','.join(map(str, missing)),
+                '--dump-format=ubjson',
+            ])
+            # States are dumped at the first dumpable call at or after each
+            # requested call
+            missing.reverse()
+            for dumped_call_no, state in read_states(p.stdout):
+                while missing and missing[-1] <= dumped_call_no:
+                    self._add_state(missing.pop(), state.get('parameters', {}))
+            p.wait()
+
+        return dict((call_no, self.states.get(call_no, {})) for call_no in call_nos)
+
+    def _add_state(self, call_no, state):
+        # States are usually compared more than once, and mostly identical
+        self.states[call_no] = jsondiff.hash_tree(state)
+        if self.cache is not None:
+            self.cache.store(self, call_no, state)
 
     def diff_state(self, ref_call_no, src_call_no, stream):
         '''Compare the state between two calls.'''
 
-        ref_state = self.dump_state(ref_call_no)
-        src_state = self.dump_state(src_call_no)
+        states = self.dump_states([ref_call_no, src_call_no])
+        ref_state = states[ref_call_no]
+        src_state = states[src_call_no]
 
         stream.flush()
         differ = jsondiff.Differ(stream)
@@ -126,58 +280,103 @@ class Retracer:
         stream.write('\n')
 
 
-def read_pnm(stream):
-    '''Read a PNM from the stream, and return the image object, and the comment.'''
+class PnmReader:
+    '''Read a sequence of PNM images from a stream, into a reusable buffer.
 
-    magic = stream.readline()
-    if not magic:
-        return None, None
-    magic = magic.rstrip()
-    if magic == 'P5':
-        channels = 1
-        bytesPerChannel = 1
-        mode = 'L'
-    elif magic == 'P6':
-        channels = 3
-        bytesPerChannel = 1
-        mode = 'RGB'
-    elif magic == 'Pf':
-        channels = 1
-        bytesPerChannel = 4
-        mode = 'R'
-    elif magic == 'PF':
-        channels = 3
-        bytesPerChannel = 4
-        mode = 'RGB'
-    elif magic == 'PX':
-        channels = 4
-        bytesPerChannel = 4
-        mode = 'RGB'
-    else:
-        raise Exception('Unsupported magic `%s`' % magic)
-    comment = ''
-    line = stream.readline()
-    while line.startswith('#'):
-        comment += line[1:]
+    When NumPy is available, images are returned as height x width x channels
+    arrays viewing the buffer, without any copies, hence they are only valid
+    until the next read.  More buffers can be used in turn, to keep images
+    valid for longer.
+    '''
+
+    def __init__(self, stream, buffers=1):
+        self.stream = stream
+        self.buffers = [bytearray() for i in range(buffers)]
+        self.index = 0
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        self.numpy = numpy
+
+    def read(self):
+        '''Read the next PNM, and return the image, and the comment.'''
+
+        stream = self.stream
+        magic = stream.readline()
+        if not magic:
+            return None, None
+        magic = magic.rstrip()
+        if magic == 'P5':
+            channels = 1
+            bytesPerChannel = 1
+            mode = 'L'
+        elif magic == 'P6':
+            channels = 3
+            bytesPerChannel = 1
+            mode = 'RGB'
+        elif magic == 'Pf':
+            channels = 1
+            bytesPerChannel = 4
+            mode = 'R'
+        elif magic == 'PF':
+            channels = 3
+            bytesPerChannel = 4
+            mode = 'RGB'
+        elif magic == 'PX':
+            channels = 4
+            bytesPerChannel = 4
+            mode = 'RGB'
+        else:
+            raise Exception('Unsupported magic `%s`' % magic)
+        comment = ''
         line = stream.readline()
-    width, height = map(int, line.strip().split())
-    maximum = int(stream.readline().strip())
-    if bytesPerChannel == 1:
-        assert maximum == 255
-    else:
-        assert maximum == 1
-    data = stream.read(height * width * channels * bytesPerChannel)
-    if bytesPerChannel == 4:
-        # Image magic only supports single channel floating point images, so
-        # represent the image as numpy arrays
-
-        import numpy
-        pixels = numpy.fromstring(data, dtype=numpy.float32)
-        pixels.resize((height, width, channels))
+        while line.startswith('#'):
+            comment += line[1:]
+            line = stream.readline()
+        width, height = map(int, line.strip().split())
+        maximum = int(stream.readline().strip())
+        if bytesPerChannel == 1:
+            assert maximum == 255
+        else:
+            assert maximum == 1
+
+        size = height * width * channels * bytesPerChannel
+        buf = self.buffers[self.index]
+        if len(buf) < size:
+            buf = bytearray(size)
+            self.buffers[self.index] = buf
+        self.index = (self.index + 1) % len(self.buffers)
+        view = memoryview(buf)
+        offset = 0
+        while offset < size:
+            count = stream.readinto(view[offset:size])
+            if not count:
+                return None, None
+            offset += count
+
+        numpy = self.numpy
+        if bytesPerChannel == 4:
+            # Image magic only supports single channel floating point images, so
+            # represent the image as numpy arrays
+            if numpy is None:
+                raise Exception('NumPy is required for floating point images')
+            dtype = numpy.float32
+        elif numpy is not None:
+            dtype = numpy.uint8
+        else:
+            image = Image.frombuffer(mode, (width, height), buffer(buf, 0, size), 'raw', mode, 0, 1)
+            return image, comment
+
+        pixels = numpy.frombuffer(buf, dtype=dtype, count=height * width * channels)
+        pixels = pixels.reshape((height, width, channels))
         return pixels, comment
 
-    image = Image.frombuffer(mode, (width, height), data, 'raw', mode, 0, 1)
-    return image, comment
+
+def read_pnm(stream):
+    '''Read a PNM from the stream, and return the image object, and the comment.'''
+
+    return PnmReader(stream).read()
 
 
 def dumpNumpyImage(output, pixels, filename):
@@ -185,7 +384,8 @@ def dumpNumpyImage(output, pixels, filename):
 
     import numpy
 
-    pixels = (pixels*255).clip(0, 255).astype('uint8')
+    if pixels.dtype != numpy.uint8:
+        pixels = (pixels*255).clip(0, 255).astype('uint8')
 
     if 0:
         # XXX: Doesn't work somehow
@@ -196,9 +396,10 @@ def dumpNumpyImage(output, pixels, filename):
         if channels == 4:
             mode = 'RGBA'
         else:
-            if channels < 3:
-                pixels = numpy.c_[arr, 255*numpy.ones((heigth * width, 3 - channels), numpy.uint8)]
-            assert channels == 3
+            if channels == 1:
+                pixels = numpy.repeat(pixels, 3, axis=1)
+            elif channels == 2:
+                pixels = numpy.c_[pixels, numpy.zeros((height * width, 1), numpy.uint8)]
             mode = 'RGB'
         im = Image.frombuffer(mode, (width, height), pixels.tostring(), 'raw', mode, 0, 1)
     im.save(filename)
@@ -214,6 +415,117 @@ def dumpNumpyImage(output, pixels, filename):
             output.write('\n')
 
 
+def compareImages(refImage, srcImage):
+    comparer = Comparer(refImage, srcImage)
+    return comparer, comparer.precision()
+
+
+def compareSnapshots(refRun, srcRun, jobs):
+    '''Generate (callNo, refImage, srcImage, comparer, precision) tuples, in
+    call order, while comparing up to jobs snapshot pairs concurrently.'''
+
+    if jobs > 1:
+        pool = ThreadPool(jobs)
+    else:
+        pool = None
+    pending = collections.deque()
+    try:
+        while True:
+            # Get the reference image
+            refImage, refCallNo = refRun.nextSnapshot()
+            if refImage is None:
+                break
+
+            # Get the source image
+            srcImage, srcCallNo = srcRun.nextSnapshot()
+            if srcImage is None:
+                break
+
+            assert refCallNo == srcCallNo
+            callNo = refCallNo
+
+            # Compare the two images
+            if pool is None:
+                comparer, precision = compareImages(refImage, srcImage)
+                yield callNo, refImage, srcImage, comparer, precision
+                continue
+
+            result = pool.apply_async(compareImages, (refImage, srcImage))
+            pending.append((callNo, refImage, srcImage, result))
+            if len(pending) >= jobs:
+                callNo, refImage, srcImage, result = pending.popleft()
+                comparer, precision = result.get()
+                yield callNo, refImage, srcImage, comparer, precision
+
+        while pending:
+            callNo, refImage, srcImage, result = pending.popleft()
+            comparer, precision = result.get()
+            yield callNo, refImage, srcImage, comparer, precision
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def retraceSnapshots(refRetracer, srcRetracer, callset, jobs):
+    '''Retrace taking snapshots at the given calls, and generate the
+    comparisons like compareSnapshots.'''
+
+    refRun = refRetracer.snapshot(callset)
+    try:
+        srcRun = srcRetracer.snapshot(callset)
+        try:
+            # Read both snapshot streams ahead, while comparing.  Besides the
+            # pending comparisons, the last compared snapshot is still in use.
+            refRun.start(jobs + 1, jobs + 1)
+            srcRun.start(jobs + 1, jobs + 1)
+
+            for snapshot in compareSnapshots(refRun, srcRun, jobs):
+                yield snapshot
+        finally:
+            srcRun.terminate()
+    finally:
+        refRun.terminate()
+
+
+def bisectSnapshots(refRetracer, srcRetracer, frequency, threshold, jobs):
+    '''Like retraceSnapshots, but only taking snapshots at the end of frames
+    at first, and then again at the given frequency in the mismatching
+    frames.
+
+    Matching frames yield just their end of frame comparison, without the
+    images.'''
+
+    # Find the mismatching frames
+    frames = []
+    for callNo, refImage, srcImage, comparer, precision in retraceSnapshots(refRetracer, srcRetracer, 'frame', jobs):
+        frames.append((callNo, precision < threshold, precision))
+
+    callset = []
+    start = 0
+    for callNo, mismatch, precision in frames:
+        if mismatch:
+            callset.append('%u-%u/%s' % (start, callNo, frequency))
+            callset.append('%u' % callNo)
+        start = callNo + 1
+
+    if callset:
+        snapshots = retraceSnapshots(refRetracer, srcRetracer, ','.join(callset), jobs)
+    else:
+        snapshots = []
+
+    # Merge the matching frames with the mismatching frames' snapshots
+    frames = [(callNo, precision) for callNo, mismatch, precision in frames if not mismatch]
+    frames.reverse()
+    for snapshot in snapshots:
+        while frames and frames[-1][0] < snapshot[0]:
+            callNo, precision = frames.pop()
+            yield callNo, None, None, None, precision
+        yield snapshot
+    while frames:
+        callNo, precision = frames.pop()
+        yield callNo, None, None, None, precision
+
+
 def parse_env(optparser, entries):
     '''Translate a list of NAME=VALUE entries into an environment dictionary.'''
 
@@ -280,10 +592,22 @@ def main():
         '-S', '--snapshot-frequency', metavar='CALLSET',
         type="string", dest="snapshot_frequency", default='draw',
         help="calls to compare [default: %default]")
+    optparser.add_option(
+        '--bisect',
+        action='store_true', dest='bisect', default=False,
+        help='compare at the end of frames first, and only then at the snapshot frequency within mismatching frames')
     optparser.add_option(
         '--diff-state',
         action='store_true', dest='diff_state', default=False,
         help='diff state between failing calls')
+    optparser.add_option(
+        '--state-cache-dir', metavar='DIR',
+        type='string', dest='state_cache_dir', default=None,
+        help='cache state dumps in DIR')
+    optparser.add_option(
+        '-j', '--jobs', metavar='NUM',
+        type="int", dest="jobs", default=1,
+        help="number of snapshot comparisons to run concurrently [default: %default]")
     optparser.add_option(
         '-o', '--output', metavar='FILE',
         type="string", dest="output",
@@ -295,13 +619,21 @@ def main():
     if not args:
         optparser.error("incorrect number of arguments")
     
+    if options.bisect and not options.snapshot_frequency.isalpha():
+        optparser.error('--bisect requires a snapshot frequency, such as draw')
+
     if options.ref_driver:
         options.ref_args.insert(0, '--driver=' + options.ref_driver)
     if options.src_driver:
         options.src_args.insert(0, '--driver=' + options.src_driver)
 
+    if options.state_cache_dir:
+        stateCache = StateCache(options.state_cache_dir)
+    else:
+        stateCache = None
+
     refRetracer = Retracer(options.retrace, options.ref_args + args, ref_env)
-    srcRetracer = Retracer(options.retrace, options.src_args + args, src_env)
+    srcRetracer = Retracer(options.retrace, options.src_args + args, src_env, stateCache)
 
     if options.output:
         output = open(options.output, 'wt')
@@ -312,82 +644,54 @@ def main():
 
     highligher.write('call\tprecision\n')
 
+    if options.bisect:
+        snapshots = bisectSnapshots(refRetracer, srcRetracer, options.snapshot_frequency, options.threshold, options.jobs)
+    else:
+        snapshots = retraceSnapshots(refRetracer, srcRetracer, options.snapshot_frequency, options.jobs)
+
     last_bad = -1
     last_good = 0
-    refRun = refRetracer.snapshot(options.snapshot_frequency)
-    try:
-        srcRun = srcRetracer.snapshot(options.snapshot_frequency)
-        try:
-            while True:
-                # Get the reference image
-                refImage, refCallNo = refRun.nextSnapshot()
-                if refImage is None:
-                    break
-
-                # Get the source image
-                srcImage, srcCallNo = srcRun.nextSnapshot()
-                if srcImage is None:
-                    break
-
-                assert refCallNo == srcCallNo
-                callNo = refCallNo
-
-                # Compare the two images
-                if isinstance(refImage, Image.Image) and isinstance(srcImage, Image.Image):
-                    # Using PIL
-                    numpyImages = False
-                    comparer = Comparer(refImage, srcImage)
-                    precision = comparer.precision()
-                else:
-                    # Using numpy (for floating point images)
-                    # TODO: drop PIL when numpy path becomes general enough
-                    import numpy
-                    assert not isinstance(refImage, Image.Image)
-                    assert not isinstance(srcImage, Image.Image)
-                    numpyImages = True
-                    assert refImage.shape == srcImage.shape
-                    diffImage = numpy.square(srcImage - refImage)
-
-                    height, width, channels = diffImage.shape
-                    square_error = numpy.sum(diffImage)
-                    square_error += numpy.finfo(numpy.float32).eps
-                    rel_error = square_error / float(height*width*channels)
-                    bits = -math.log(rel_error)/math.log(2.0)
-                    precision = bits
-
-                mismatch = precision < options.threshold
-
-                if mismatch:
-                    highligher.color(highligher.red)
-                    highligher.bold()
-                highligher.write('%u\t%f\n' % (callNo, precision))
-                if mismatch:
-                    highligher.normal()
-
-                if mismatch:
-                    if options.diff_prefix:
-                        prefix = os.path.join(options.diff_prefix, '%010u' % callNo)
-                        prefix_dir = os.path.dirname(prefix)
-                        if not os.path.isdir(prefix_dir):
-                            os.makedirs(prefix_dir)
-                        if numpyImages:
-                            dumpNumpyImage(output, refImage, prefix + '.ref.png')
-                            dumpNumpyImage(output, srcImage, prefix + '.src.png')
-                        else:
-                            refImage.save(prefix + '.ref.png')
-                            srcImage.save(prefix + '.src.png')
-                            comparer.write_diff(prefix + '.diff.png')
-                    if last_bad < last_good and options.diff_state:
-                        srcRetracer.diff_state(last_good, callNo, output)
-                    last_bad = callNo
+    state_diffs = []
+    for callNo, refImage, srcImage, comparer, precision in snapshots:
+        mismatch = precision < options.threshold
+
+        if mismatch:
+            highligher.color(highligher.red)
+            highligher.bold()
+        highligher.write('%u\t%f\n' % (callNo, precision))
+        if mismatch:
+            highligher.normal()
+
+        if mismatch:
+            if options.diff_prefix:
+                prefix = os.path.join(options.diff_prefix, '%010u' % callNo)
+                prefix_dir = os.path.dirname(prefix)
+                if not os.path.isdir(prefix_dir):
+                    os.makedirs(prefix_dir)
+                if isinstance(refImage, Image.Image):
+                    refImage.save(prefix + '.ref.png')
+                    srcImage.save(prefix + '.src.png')
                 else:
-                    last_good = callNo
-
-                highligher.flush()
-        finally:
-            srcRun.terminate()
-    finally:
-        refRun.terminate()
+                    dumpNumpyImage(output, refImage, prefix + '.ref.png')
+                    dumpNumpyImage(output, srcImage, prefix + '.src.png')
+                comparer.write_diff(prefix + '.diff.png')
+            if last_bad < last_good and options.diff_state:
+                state_diffs.append((last_good, callNo))
+            last_bad = callNo
+        else:
+            last_good = callNo
+
+        highligher.flush()
+
+    # Dump all the states needed in a single retrace
+    if state_diffs:
+        srcRetracer.dump_states([call_no for state_diff in state_diffs for call_no in state_diff])
+        for ref_call_no, src_call_no in state_diffs:
+            highligher.bold()
+            highligher.write('state %u..%u\n' % (ref_call_no, src_call_no))
+            highligher.normal()
+            highligher.flush()
+            srcRetracer.diff_state(ref_call_no, src_call_no, output)
 
 
 if __name__ == '__main__':
@@ -33,21 +33,30 @@
 import sys
 import os.path
 import optparse
+import itertools
 import math
+import multiprocessing
 import operator
+from cStringIO import StringIO
 
 from PIL import Image
 from PIL import ImageChops
 from PIL import ImageEnhance
 from PIL import ImageFilter
+from PIL import ImageStat
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 thumbSize = 320
 
 gaussian_kernel = ImageFilter.Kernel((3, 3), [1, 2, 1, 2, 4, 2, 1, 2, 1], 16)
 
-class Comparer:
-    '''Image comparer.'''
+class PilComparer:
+    '''Image comparer, using PIL only.'''
 
     def __init__(self, ref_image, src_image, alpha = False):
         if isinstance(ref_image, basestring):
@@ -113,6 +122,184 @@ class Comparer:
         ae = sum(h[int(255 * fuzz) + 1 : 256])
         return ae
 
+    def channel_stats(self):
+        '''Return the (maximum, root mean square) error of each channel,
+        normalized to [0, 1].'''
+
+        if self.size_mismatch():
+            return []
+
+        stat = ImageStat.Stat(self.diff)
+        return [(hi/255.0, rms/255.0) for (lo, hi), rms in zip(stat.extrema, stat.rms)]
+
+
+def image_to_array(image, alpha = False):
+    '''Convert an image (file name, PIL image, or NumPy array) into a
+    height x width x channels NumPy array.'''
+
+    if isinstance(image, basestring):
+        image = Image.open(image)
+
+    if isinstance(image, Image.Image):
+        if alpha:
+            if image.mode != 'RGBA':
+                image = image.convert('RGBA')
+        else:
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+        pixels = numpy.asarray(image)
+    else:
+        pixels = numpy.asarray(image)
+
+    if pixels.ndim == 2:
+        pixels = pixels.reshape(pixels.shape + (1,))
+    return pixels
+
+
+def gaussian_filter(pixels):
+    '''Same as gaussian_kernel, leaving the borders unfiltered like PIL does.'''
+
+    if pixels.dtype == numpy.uint8:
+        p = pixels.astype(numpy.uint16)
+    else:
+        p = pixels
+    rows = p[:-2] + 2*p[1:-1] + p[2:]
+    cols = rows[:, :-2] + 2*rows[:, 1:-1] + rows[:, 2:]
+
+    result = pixels.copy()
+    if pixels.dtype == numpy.uint8:
+        result[1:-1, 1:-1] = (cols + 8) >> 4
+    else:
+        result[1:-1, 1:-1] = cols / 16.0
+    return result
+
+
+class NumpyComparer:
+    '''Image comparer, using NumPy.
+
+    Takes both 8-bit images (as file names or PIL images), and floating point
+    images (as height x width x channels NumPy arrays, as returned by
+    retracediff.read_pnm), and computes all errors exactly, per channel.
+    '''
+
+    def __init__(self, ref_image, src_image, alpha = False):
+        self.ref = image_to_array(ref_image, alpha)
+        self.src = image_to_array(src_image, alpha)
+
+        if self.ref.dtype == numpy.uint8 and self.src.dtype == numpy.uint8:
+            self.scale = 255
+            # Matches the rounding term of PilComparer.precision
+            self.eps = 0.5/(255*255)
+        else:
+            if self.ref.dtype == numpy.uint8:
+                self.ref = self.ref.astype(numpy.float32) / 255.0
+            if self.src.dtype == numpy.uint8:
+                self.src = self.src.astype(numpy.float32) / 255.0
+            self.scale = 1.0
+            self.eps = numpy.finfo(numpy.float32).eps
+
+        if self.size_mismatch():
+            self.diff = None
+        elif self.scale == 255:
+            self.diff = numpy.absolute(self.src.astype(numpy.int16) - self.ref).astype(numpy.uint8)
+        else:
+            self.diff = numpy.absolute(self.src - self.ref)
+        self._pixel_diff = None
+
+    def size_mismatch(self):
+        return self.ref.shape != self.src.shape
+
+    def pixel_diff(self):
+        '''Largest difference among the channels of each pixel.'''
+
+        if self._pixel_diff is None:
+            self._pixel_diff = self.diff.max(axis=2)
+        return self._pixel_diff
+
+    def write_diff(self, diff_image, fuzz = 0.05):
+        if self.size_mismatch():
+            return
+
+        # make a difference image similar to ImageMagick's compare utility
+        mask = self.pixel_diff().astype(numpy.float32) * (1.0/(fuzz*self.scale))
+        mask = numpy.minimum(mask, 1.0)
+        mask = mask.reshape(mask.shape + (1,))
+
+        lowlight = numpy.array([0xff, 0xff, 0xff], dtype=numpy.float32)
+        highlight = numpy.array([0xf1, 0x00, 0x1e], dtype=numpy.float32)
+        diff = lowlight + mask*(highlight - lowlight)
+
+        src = self.src
+        if src.shape[2] >= 3:
+            src = src[:, :, :3]
+        else:
+            src = src[:, :, :1]
+        src = src.astype(numpy.float32) * (255.0/self.scale)
+
+        pixels = src + (diff - src)*(0xcc/255.0)
+        pixels = (pixels + 0.5).clip(0, 255).astype(numpy.uint8)
+
+        height, width, channels = pixels.shape
+        diff_im = Image.frombuffer('RGB', (width, height), pixels.tostring(), 'raw', 'RGB', 0, 1)
+        diff_im.save(diff_image)
+
+    def precision(self, filter=False):
+        if self.size_mismatch():
+            return 0.0
+
+        diff = self.diff
+        if filter:
+            diff = gaussian_filter(diff)
+
+        if diff.dtype == numpy.uint8:
+            # Exact sum of squares, from the histogram
+            h = numpy.bincount(diff.ravel(), minlength=256)
+            square_error = float(numpy.dot(h, numpy.arange(256, dtype=numpy.int64)**2))
+        else:
+            square_error = float(numpy.sum(numpy.square(diff), dtype=numpy.float64))
+        rel_error = (square_error/(self.scale*self.scale) + self.eps) / float(diff.size)
+        bits = -math.log(rel_error)/math.log(2.0)
+        return bits
+
+    def ae(self, fuzz = 0.05):
+        # Compute absolute error, ie, the number of pixels with any channel
+        # differing by more than fuzz
+
+        if self.size_mismatch():
+            return sys.maxint
+
+        if self.scale == 255:
+            threshold = int(255 * fuzz)
+        else:
+            threshold = fuzz
+        return int(numpy.count_nonzero(self.pixel_diff() > threshold))
+
+    def channel_stats(self):
+        '''Return the (maximum, root mean square) error of each channel,
+        normalized to [0, 1].'''
+
+        if self.size_mismatch():
+            return []
+
+        height, width, channels = self.diff.shape
+        stats = []
+        for channel in range(channels):
+            diff = self.diff[:, :, channel]
+            if diff.dtype == numpy.uint8:
+                h = numpy.bincount(diff.ravel(), minlength=256)
+                square_error = float(numpy.dot(h, numpy.arange(256, dtype=numpy.int64)**2))
+            else:
+                square_error = float(numpy.sum(numpy.square(diff), dtype=numpy.float64))
+            rms = math.sqrt(square_error/(height*width)) / self.scale
+            stats.append((float(diff.max()) / self.scale, rms))
+        return stats
+
+
+if numpy is None:
+    Comparer = PilComparer
+else:
+    Comparer = NumpyComparer
+
 
 def surface(html, image):
     if True:
@@ -163,6 +350,48 @@ def find_images(prefix):
     return images
 
 
+def compare_images(args):
+    '''Compare an image pair, writing the difference image and thumbnails as
+    needed, and return the image, the result, and its HTML report row.
+
+    Runs on the worker processes in parallel mode.'''
+
+    image, ref_prefix, src_prefix, options = args
+
+    ref_image = ref_prefix + image
+    src_image = src_prefix + image
+    root, ext = os.path.splitext(src_image)
+    delta_image = "%s.diff.png" % (root, )
+    if not os.path.exists(ref_image) or not os.path.exists(src_image):
+        return image, None, ''
+
+    comparer = Comparer(ref_image, src_image, options.alpha)
+    match = comparer.ae(fuzz=options.fuzz) == 0
+    if match:
+        result = 'MATCH'
+        bgcolor = '#20ff20'
+    else:
+        result = 'MISMATCH'
+        bgcolor = '#ff2020'
+        if options.verbose:
+            stats = ' '.join(['%.3f/%.3f' % stat for stat in comparer.channel_stats()])
+            result += ' (max/rms %s)' % stats
+    html = StringIO()
+    html.write('      <tr>\n')
+    html.write('        <td bgcolor="%s"><a href="%s">%s<a/></td>\n' % (bgcolor, ref_image, image))
+    if not match or options.show_all:
+        if options.overwrite \
+           or not os.path.exists(delta_image) \
+           or (os.path.getmtime(delta_image) < os.path.getmtime(ref_image) \
+               and os.path.getmtime(delta_image) < os.path.getmtime(src_image)):
+            comparer.write_diff(delta_image, fuzz=options.fuzz)
+        surface(html, ref_image)
+        surface(html, src_image)
+        surface(html, delta_image)
+    html.write('      </tr>\n')
+    return image, result, html.getvalue()
+
+
 def main():
     global options
 
@@ -192,6 +421,10 @@ def main():
         '--show-all',
         action="store_true", dest="show_all", default=False,
         help="show all images, including similar ones")
+    optparser.add_option(
+        '-j', '--jobs', metavar='NUM',
+        type="int", dest="jobs", default=1,
+        help="number of images to compare in parallel [default: %default]")
 
     (options, args) = optparser.parse_args(sys.argv[1:])
 
@@ -215,38 +448,26 @@ def main():
     html.write('    <table border="1">\n')
     html.write('      <tr><th>File</th><th>%s</th><th>%s</th><th>&Delta;</th></tr>\n' % (ref_prefix, src_prefix))
     failures = 0
-    for image in images:
-        ref_image = ref_prefix + image
-        src_image = src_prefix + image
-        root, ext = os.path.splitext(src_image)
-        delta_image = "%s.diff.png" % (root, )
-        if os.path.exists(ref_image) and os.path.exists(src_image):
+    tasks = [(image, ref_prefix, src_prefix, options) for image in images]
+    if options.jobs > 1:
+        pool = multiprocessing.Pool(options.jobs)
+        results = pool.imap(compare_images, tasks, 16)
+    else:
+        pool = None
+        results = itertools.imap(compare_images, tasks)
+    try:
+        for image, result, row in results:
+            if result is None:
+                continue
             if options.verbose:
-                sys.stdout.write('Comparing %s and %s ...' % (ref_image, src_image))
-            comparer = Comparer(ref_image, src_image, options.alpha)
-            match = comparer.ae(fuzz=options.fuzz) == 0
-            if match:
-                result = 'MATCH'
-                bgcolor = '#20ff20'
-            else:
-                result = 'MISMATCH'
+                sys.stdout.write('Comparing %s and %s ... %s\n' % (ref_prefix + image, src_prefix + image, result))
+            if result != 'MATCH':
                 failures += 1
-                bgcolor = '#ff2020'
-            if options.verbose:
-                sys.stdout.write(' %s\n' % (result,))
-            html.write('      <tr>\n')
-            html.write('        <td bgcolor="%s"><a href="%s">%s<a/></td>\n' % (bgcolor, ref_image, image))
-            if not match or options.show_all:
-                if options.overwrite \
-                   or not os.path.exists(delta_image) \
-                   or (os.path.getmtime(delta_image) < os.path.getmtime(ref_image) \
-                       and os.path.getmtime(delta_image) < os.path.getmtime(src_image)):
-                    comparer.write_diff(delta_image, fuzz=options.fuzz)
-                surface(html, ref_image)
-                surface(html, src_image)
-                surface(html, delta_image)
-            html.write('      </tr>\n')
+            html.write(row)
             html.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
     html.write('    </table>\n')
     html.write('  </body>\n')
     html.write('</html>\n')
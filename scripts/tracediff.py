@@ -25,11 +25,17 @@
 ##########################################################################/
 
 
-import difflib
+import array
+import bisect
+import cPickle as pickle
+import cStringIO
+import hashlib
 import itertools
+import multiprocessing
 import optparse
 import os.path
 import platform
+import re
 import shutil
 import subprocess
 import sys
@@ -193,13 +199,208 @@ class ExternalDiffer(Differ):
             less.wait()
 
 
+##########################################################################/
+#
+# Diff engine
+#
+# Patience diff, falling back to Myers' O(ND) algorithm between unique
+# anchors, as a faster replacement for difflib.SequenceMatcher, which
+# degrades badly on long and repetitive sequences.
+#
+
+
+# Maximum number of edits the Myers algorithm will search for, before giving
+# up and reporting the whole region as replaced.
+maxMyersCost = 2000
+
+
+def _myersBlocks(a, alo, ahi, b, blo, bhi, blocks):
+    n = ahi - alo
+    m = bhi - blo
+    maxCost = min(n + m, maxMyersCost)
+
+    # v[k] holds the furthest x reached on diagonal k; bands[d] is the slice
+    # of v for diagonals -d..d after d edits, kept for the backtracking.
+    offset = maxCost + 1
+    v = array.array('l', [0]) * (2*offset + 1)
+    bands = []
+    for d in xrange(maxCost + 1):
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                bands.append(v[offset - d : offset + d + 1])
+                break
+        else:
+            bands.append(v[offset - d : offset + d + 1])
+            continue
+        break
+    else:
+        # Too many differences
+        return
+
+    x, y = n, m
+    for d in xrange(len(bands) - 1, 0, -1):
+        k = x - y
+        prev = bands[d - 1]
+        if k == -d or (k != d and prev[k - 1 + d - 1] < prev[k + 1 + d - 1]):
+            prevK = k + 1
+            prevX = prev[prevK + d - 1]
+            midX = prevX
+        else:
+            prevK = k - 1
+            prevX = prev[prevK + d - 1]
+            midX = prevX + 1
+        if x > midX:
+            blocks.append((alo + midX, blo + midX - k, x - midX))
+        x = prevX
+        y = prevX - prevK
+    if x > 0:
+        blocks.append((alo, blo, x))
+
+
+def _patienceBlocks(a, alo, ahi, b, blo, bhi, isjunk, blocks):
+    '''Append to blocks the (i, j, n) triples of a[alo:ahi] and b[blo:bhi]
+    that match, as found by the patience diff, or by the Myers algorithm
+    where there are no anchors.  They needn't be the same blocks difflib
+    would find, and past maxMyersCost edits a region is left unmatched.'''
+
+    # Common prefix and suffix
+    lo = 0
+    while alo + lo < ahi and blo + lo < bhi and a[alo + lo] == b[blo + lo]:
+        lo += 1
+    if lo:
+        blocks.append((alo, blo, lo))
+        alo += lo
+        blo += lo
+    hi = 0
+    while alo < ahi - hi and blo < bhi - hi and a[ahi - hi - 1] == b[bhi - hi - 1]:
+        hi += 1
+    if hi:
+        blocks.append((ahi - hi, bhi - hi, hi))
+        ahi -= hi
+        bhi -= hi
+
+    if alo == ahi or blo == bhi:
+        return
+
+    # Elements that occur exactly once in each side are the anchors
+    occurrences = {}
+    for i in xrange(alo, ahi):
+        item = a[i]
+        try:
+            occurrences[item][0] += 1
+        except KeyError:
+            occurrences[item] = [1, 0, i, None]
+    for j in xrange(blo, bhi):
+        try:
+            occurrence = occurrences[b[j]]
+        except KeyError:
+            continue
+        occurrence[1] += 1
+        occurrence[3] = j
+    anchors = [
+        (i, j)
+        for item, (aCount, bCount, i, j) in occurrences.iteritems()
+        if aCount == 1 and bCount == 1 and not (isjunk is not None and isjunk(item))
+    ]
+    del occurrences
+
+    if not anchors:
+        _myersBlocks(a, alo, ahi, b, blo, bhi, blocks)
+        return
+
+    # Longest increasing subsequence of the anchors' positions in b, when
+    # sorted by their positions in a
+    anchors.sort()
+    tails = []
+    tailIndices = []
+    predecessors = []
+    for index, (i, j) in enumerate(anchors):
+        pos = bisect.bisect_left(tails, j)
+        if pos == len(tails):
+            tails.append(j)
+            tailIndices.append(index)
+        else:
+            tails[pos] = j
+            tailIndices[pos] = index
+        predecessors.append(tailIndices[pos - 1] if pos else None)
+    chain = []
+    index = tailIndices[-1]
+    while index is not None:
+        chain.append(anchors[index])
+        index = predecessors[index]
+    chain.reverse()
+
+    # Recurse between consecutive anchors
+    for i, j in chain:
+        _patienceBlocks(a, alo, i, b, blo, j, isjunk, blocks)
+        blocks.append((i, j, 1))
+        alo = i + 1
+        blo = j + 1
+    _patienceBlocks(a, alo, ahi, b, blo, bhi, isjunk, blocks)
+
+
+def getMatchingBlocks(a, b, isjunk = None):
+    '''Matching blocks in the same format as
+    difflib.SequenceMatcher(isjunk, a, b).get_matching_blocks(), but not
+    necessarily the same blocks; see _patienceBlocks.'''
+
+    blocks = []
+    _patienceBlocks(a, 0, len(a), b, 0, len(b), isjunk, blocks)
+    blocks.sort()
+
+    # Merge adjacent blocks
+    matchingBlocks = []
+    i1 = j1 = k1 = 0
+    for i2, j2, k2 in blocks:
+        if i1 + k1 == i2 and j1 + k1 == j2:
+            k1 += k2
+        else:
+            if k1:
+                matchingBlocks.append((i1, j1, k1))
+            i1, j1, k1 = i2, j2, k2
+    if k1:
+        matchingBlocks.append((i1, j1, k1))
+    matchingBlocks.append((len(a), len(b), 0))
+    return matchingBlocks
+
+
+def getOpcodes(a, b, isjunk = None):
+    '''Opcodes in the same format as
+    difflib.SequenceMatcher(isjunk, a, b).get_opcodes(), but not
+    necessarily the same opcodes, as they come from getMatchingBlocks.'''
+
+    opcodes = []
+    i = j = 0
+    for ai, bj, size in getMatchingBlocks(a, b, isjunk):
+        if i < ai and j < bj:
+            opcodes.append(('replace', i, ai, j, bj))
+        elif i < ai:
+            opcodes.append(('delete', i, ai, j, j))
+        elif j < bj:
+            opcodes.append(('insert', i, i, j, bj))
+        i = ai + size
+        j = bj + size
+        if size:
+            opcodes.append(('equal', ai, i, bj, j))
+    return opcodes
+
+
 ##########################################################################/
 #
 # Python diff
 #
 
-from unpickle import Unpickler, Dumper, Rebuilder
-from highlight import PlainHighlighter, LessHighlighter
+from unpickle import Unpickler, CallList, Dumper, CALL_FLAG_END_FRAME
+from highlight import PlainHighlighter, AnsiHighlighter, LessHighlighter
 
 
 ignoredFunctionNames = set([
@@ -213,118 +414,483 @@ ignoredFunctionNames = set([
 ])
 
 
-class Blob:
-    '''Data-less proxy for bytearrays, to save memory.'''
-
-    def __init__(self, size, hash):
-        self.size = size
-        self.hash = hash
+class Loader(Unpickler):
 
-    def __repr__(self):
-        return 'blob(%u)' % self.size
+    def __init__(self, stream):
+        Unpickler.__init__(self, stream)
+        self.calls = CallList()
 
-    def __eq__(self, other):
-        return isinstance(other, Blob) and self.size == other.size and self.hash == other.hash
+    def handleCall(self, call):
+        if call.functionName not in ignoredFunctionNames:
+            self.calls.append(call)
 
-    def __hash__(self):
-        return self.hash
 
+class FrameLoader(Loader):
+    '''Loader which reads calls incrementally, one frame at a time.'''
 
-class BlobReplacer(Rebuilder):
-    '''Replace blobs with proxys.'''
+    def __init__(self, stream):
+        Loader.__init__(self, stream)
+        self.eof = False
+        self.frameEnded = False
 
-    def visitByteArray(self, obj):
-        return Blob(len(obj), hash(str(obj)))
+    def handleCall(self, call):
+        Loader.handleCall(self, call)
+        if call.flags & CALL_FLAG_END_FRAME:
+            self.frameEnded = True
 
-    def visitCall(self, call):
-        call.args = map(self.visit, call.args)
-        call.ret = self.visit(call.ret)
+    def readFrame(self):
+        self.frameEnded = False
+        while not self.eof and not self.frameEnded:
+            if not self.parseCall():
+                self.eof = True
 
 
-class Loader(Unpickler):
+class FrameEndLoader(Unpickler):
+    '''Collect the numbers of the calls that end frames.'''
 
     def __init__(self, stream):
         Unpickler.__init__(self, stream)
-        self.calls = []
-        self.rebuilder = BlobReplacer()
+        self.callNos = []
 
     def handleCall(self, call):
-        if call.functionName not in ignoredFunctionNames:
-            self.rebuilder.visitCall(call)
-            self.calls.append(call)
+        self.callNos.append(call.no)
+
+
+def pickleTrace(apitrace, trace, calls):
+    '''Start pickling the given calls of a trace.'''
+
+    return subprocess.Popen(
+        args = [
+            apitrace,
+            'pickle',
+            '--symbolic',
+            '--blob-digests',
+            '--format=chunked',
+            '--calls=' + calls,
+            trace
+        ],
+        stdout = subprocess.PIPE,
+    )
+
+
+def loadTrace(apitrace, trace, calls, factory = Loader):
+    '''Pickle the given calls of a trace, and parse them with a loader.'''
+
+    p = pickleTrace(apitrace, trace, calls)
+    loader = factory(p.stdout)
+    loader.parse()
+    p.wait()
+    return loader
+
+
+def loadTraceShard(args):
+    apitrace, trace, calls = args
+    return loadTrace(apitrace, trace, calls).calls
+
+
+callRangeRE = re.compile(r'^\s*(?:\*|(\d+)\s*-\s*(\d*))\s*$')
+
+
+def shardCalls(apitrace, trace, calls, numShards):
+    '''Split a call range into roughly equally sized callsets that start
+    and end at frame boundaries.
+
+    Only plain call ranges (such as "*", "0-10000", or "1000-") can be split,
+    other callsets are returned unchanged.
+    '''
+
+    mo = callRangeRE.match(calls)
+    if numShards <= 1 or mo is None:
+        return [calls]
+
+    start, stop = mo.groups()
+    start = int(start or 0)
+    stop = int(stop) if stop else None
+
+    frameEnds = loadTrace(apitrace, trace, calls + '/frame', FrameEndLoader).callNos
+    if not frameEnds:
+        return [calls]
+
+    last = frameEnds[-1] if stop is None else stop
+    cuts = []
+    for i in range(1, numShards):
+        target = start + (last - start) * i // numShards
+        j = bisect.bisect_left(frameEnds, target)
+        if j < len(frameEnds) and frameEnds[j] < last and (not cuts or frameEnds[j] > cuts[-1]):
+            cuts.append(frameEnds[j])
+
+    shards = []
+    lo = start
+    for cut in cuts:
+        shards.append('%u-%u' % (lo, cut))
+        lo = cut + 1
+    shards.append('%u-%s' % (lo, '' if stop is None else stop))
+    return shards
+
+
+class FrameKey(object):
+    '''Hashable tuple of call keys or function names of a frame, which
+    caches its hash.'''
+
+    __slots__ = ('items', '_hash')
+
+    def __init__(self, items):
+        self.items = items
+        self._hash = hash(items)
+
+    def __eq__(self, other):
+        return self._hash == other._hash and self.items == other.items
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self._hash
+
+
+def getFrameBounds(calls):
+    '''Split a CallList into frames, returning the index of the first call
+    of each frame, followed by the total number of calls.'''
+
+    bounds = [0]
+    for i, flags in enumerate(calls.flags):
+        if flags & CALL_FLAG_END_FRAME:
+            bounds.append(i + 1)
+    if bounds[-1] < len(calls):
+        bounds.append(len(calls))
+    return bounds
+
+
+def alignFrames(a, b):
+    '''Diff two CallLists frame by frame.
+
+    Frames are first matched by their contents.  The remaining frames are then
+    paired by their structure (i.e., the sequence of function names), so that
+    slightly changed frames still get diffed against each other.
+
+    Returns opcodes like getOpcodes, except that 'replace' opcodes span
+    either a single pair of frames, or a run of frames that could not be
+    paired, and must be further diffed call by call.
+    '''
+
+    aBounds = getFrameBounds(a)
+    bBounds = getFrameBounds(b)
+
+    def contents(calls, bounds):
+        return [FrameKey(tuple(calls.keys[lo:hi])) for lo, hi in zip(bounds, bounds[1:])]
+
+    def shapes(calls, bounds, lo, hi):
+        return [
+            FrameKey(tuple([calls.functionName(i) for i in xrange(bounds[frame], bounds[frame + 1])]))
+            for frame in xrange(lo, hi)
+        ]
+
+    opcodes = []
+    for tag, i1, i2, j1, j2 in getOpcodes(contents(a, aBounds), contents(b, bBounds)):
+        if tag == 'equal':
+            opcodes.append((tag, aBounds[i1], aBounds[i2], bBounds[j1], bBounds[j2]))
+            continue
+
+        aShapes = shapes(a, aBounds, i1, i2)
+        bShapes = shapes(b, bBounds, j1, j2)
+        for tag, k1, k2, l1, l2 in getOpcodes(aShapes, bShapes):
+            k1 += i1
+            k2 += i1
+            l1 += j1
+            l2 += j1
+            if tag in ('equal', 'replace') and k2 - k1 == l2 - l1:
+                for i, j in zip(xrange(k1, k2), xrange(l1, l2)):
+                    opcodes.append(('replace', aBounds[i], aBounds[i + 1], bBounds[j], bBounds[j + 1]))
+            else:
+                opcodes.append((tag, aBounds[k1], aBounds[k2], bBounds[l1], bBounds[l2]))
+    return opcodes
+
+
+def diffRange(a, alo, ahi, b, blo, bhi, isjunk = None):
+    '''Diff the given ranges of two CallLists, call by call.'''
+
+    return [
+        (tag, alo + i1, alo + i2, blo + j1, blo + j2)
+        for tag, i1, i2, j1, j2 in getOpcodes(a.keys[alo:ahi], b.keys[blo:bhi], isjunk)
+    ]
+
+
+def refineOpcodes(a, b, opcodes, isjunk = None):
+    '''Diff call by call the 'replace' opcodes returned by alignFrames.'''
+
+    refinedOpcodes = []
+    for opcode in opcodes:
+        tag, alo, ahi, blo, bhi = opcode
+        if tag == 'replace':
+            refinedOpcodes.extend(diffRange(a, alo, ahi, b, blo, bhi, isjunk))
+        else:
+            refinedOpcodes.append(opcode)
+    return refinedOpcodes
+
+
+def diffCalls(a, b, isjunk = None):
+    '''Diff two CallLists, aligning frames first, and then diffing the
+    mismatching frames independently.'''
+
+    return refineOpcodes(a, b, alignFrames(a, b), isjunk)
+
+
+class TraceCache:
+    '''On-disk cache of loaded traces, keyed by the trace path, modification
+    time, and callset.'''
+
+    version = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def getPath(self, trace, calls):
+        st = os.stat(trace)
+        key = repr((self.version, os.path.abspath(trace), st.st_mtime, st.st_size, calls, sorted(ignoredFunctionNames)))
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + '.pickle')
+
+    def load(self, trace, calls):
+        try:
+            stream = open(self.getPath(trace, calls), 'rb')
+        except IOError:
+            return None
+        try:
+            return pickle.load(stream)
+        except (EOFError, pickle.UnpicklingError):
+            return None
+        finally:
+            stream.close()
+
+    def store(self, trace, calls, traceCalls):
+        path = self.getPath(trace, calls)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # Write to a temporary file first, so that concurrent or interrupted
+        # runs never see incomplete entries
+        fd, tmpPath = tempfile.mkstemp(dir = self.directory)
+        stream = os.fdopen(fd, 'wb')
+        try:
+            pickle.dump(traceCalls, stream, pickle.HIGHEST_PROTOCOL)
+        finally:
+            stream.close()
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmpPath, path)
+
+
+# Maximum number of frames, in multiples of the window size, that windowed
+# diffs will hold while looking for common calls
+maxWindowFactor = 4
+
+
+# Maximum number of common calls formatted by a single parallel job
+maxEqualShardSize = 4096
+
+
+def diffShard(args):
+    '''Diff and format a shard of the traces, returning the output text.'''
+
+    options, highlighterClass, tag, a, b, aSpace, bSpace = args
+
+    stream = cStringIO.StringIO()
+    differ = PythonDiffer(None, options, highlighterClass(stream))
+    differ.a = a
+    differ.b = b
+    differ.aSpace = aSpace
+    differ.bSpace = bSpace
+    if tag == 'replace':
+        for opcode in diffRange(a, 0, len(a), b, 0, len(b), differ.isjunk):
+            differ.dispatch(*opcode)
+    else:
+        differ.dispatch(tag, 0, len(a), 0, len(b))
+    return stream.getvalue()
 
 
 class PythonDiffer(Differ):
 
-    def __init__(self, apitrace, options):
+    def __init__(self, apitrace, options, highlighter = None):
         Differ.__init__(self, apitrace)
         self.a = None
         self.b = None
-        if self.isatty:
-            self.highlighter = LessHighlighter()
-        else:
-            self.highlighter = PlainHighlighter()
+        if highlighter is None:
+            if self.isatty:
+                highlighter = LessHighlighter()
+            else:
+                highlighter = PlainHighlighter()
+        self.highlighter = highlighter
         self.delete_color = self.highlighter.red
         self.insert_color = self.highlighter.green
+        self.options = options
         self.callNos = options.callNos
         self.suppressCommonLines = options.suppressCommonLines
+        self.jobs = options.jobs
+        self.window = options.window
+        self.pool = None
+        if options.cacheDir is not None:
+            self.cache = TraceCache(options.cacheDir)
+        else:
+            self.cache = None
         self.aSpace = 0
         self.bSpace = 0
         self.dumper = Dumper()
 
     def setRefTrace(self, refTrace, ref_calls):
-        self.a = self.readTrace(refTrace, ref_calls)
+        if self.window:
+            self.aLoader = FrameLoader(pickleTrace(self.apitrace, refTrace, ref_calls).stdout)
+        else:
+            self.a = self.readTrace(refTrace, ref_calls)
 
     def setSrcTrace(self, srcTrace, src_calls):
-        self.b = self.readTrace(srcTrace, src_calls)
+        if self.window:
+            self.bLoader = FrameLoader(pickleTrace(self.apitrace, srcTrace, src_calls).stdout)
+        else:
+            self.b = self.readTrace(srcTrace, src_calls)
 
-    def readTrace(self, trace, calls):
-        p = subprocess.Popen(
-            args = [
-                self.apitrace,
-                'pickle',
-                '--symbolic',
-                '--calls=' + calls,
-                trace
-            ],
-            stdout = subprocess.PIPE,
-        )
+    def getPool(self):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.jobs)
+        return self.pool
 
-        parser = Loader(p.stdout)
-        parser.parse()
-        return parser.calls
+    def readTrace(self, trace, calls):
+        if self.cache is not None:
+            traceCalls = self.cache.load(trace, calls)
+            if traceCalls is not None:
+                return traceCalls
+
+        traceCalls = self._readTrace(trace, calls)
+
+        if self.cache is not None:
+            self.cache.store(trace, calls, traceCalls)
+        return traceCalls
+
+    def _readTrace(self, trace, calls):
+        shards = shardCalls(self.apitrace, trace, calls, self.jobs)
+        if len(shards) == 1:
+            return loadTrace(self.apitrace, trace, calls).calls
+
+        # Pickle and parse each shard in parallel, and concatenate the results
+        # in order
+        shardArgs = [(self.apitrace, trace, shard) for shard in shards]
+        calls = CallList()
+        for shard in self.getPool().map(loadTraceShard, shardArgs):
+            calls.extend(shard)
+        return calls
 
     def diff(self):
         try:
-            self._diff()
+            if self.window:
+                self._diffWindowed()
+            elif self.jobs > 1:
+                self._diffParallel()
+            else:
+                self._diff()
         except IOError:
             pass
+        if self.pool is not None:
+            self.pool.terminate()
 
     def _diff(self):
-        matcher = difflib.SequenceMatcher(self.isjunk, self.a, self.b)
-        for tag, alo, ahi, blo, bhi in matcher.get_opcodes():
-            if tag == 'replace':
-                self.replace(alo, ahi, blo, bhi)
-            elif tag == 'delete':
-                self.delete(alo, ahi, blo, bhi)
-            elif tag == 'insert':
-                self.insert(alo, ahi, blo, bhi)
-            elif tag == 'equal':
-                self.equal(alo, ahi, blo, bhi)
+        for tag, alo, ahi, blo, bhi in diffCalls(self.a, self.b, self.isjunk):
+            self.dispatch(tag, alo, ahi, blo, bhi)
+
+    def _diffWindowed(self):
+        # Read and diff a few frames at a time, but only output up to the
+        # last frames common to both traces, as the frames after them might
+        # still match frames not yet read.
+        maxFrames = maxWindowFactor * self.window
+        while True:
+            for i in xrange(self.window):
+                self.aLoader.readFrame()
+                self.bLoader.readFrame()
+            self.a = self.aLoader.calls
+            self.b = self.bLoader.calls
+
+            frameOpcodes = alignFrames(self.a, self.b)
+            if self.aLoader.eof and self.bLoader.eof:
+                for opcode in refineOpcodes(self.a, self.b, frameOpcodes, self.isjunk):
+                    self.dispatch(*opcode)
+                return
+
+            end = len(frameOpcodes)
+            while end > 0 and frameOpcodes[end - 1][0] != 'equal':
+                end -= 1
+            if end > 0:
+                opcodes = refineOpcodes(self.a, self.b, frameOpcodes[:end], self.isjunk)
             else:
-                raise ValueError, 'unknown tag %s' % (tag,)
+                aBounds = getFrameBounds(self.a)
+                if len(aBounds) <= maxFrames and len(getFrameBounds(self.b)) <= maxFrames:
+                    continue
+
+                # No common frames in sight, so output up to the last common
+                # calls in the older half of the pending frames
+                opcodes = refineOpcodes(self.a, self.b, frameOpcodes, self.isjunk)
+                limit = aBounds[len(aBounds) // 2]
+                end = len(opcodes)
+                while end > 0 and not (opcodes[end - 1][0] == 'equal' and opcodes[end - 1][2] <= limit):
+                    end -= 1
+                if end == 0:
+                    end = len(opcodes)
+                opcodes = opcodes[:end]
+
+            for opcode in opcodes:
+                self.dispatch(*opcode)
+            self.highlighter.flush()
+
+            tag, alo, ahi, blo, bhi = opcodes[-1]
+            self.aLoader.calls = self.a[ahi:]
+            self.bLoader.calls = self.b[bhi:]
+
+    def _diffParallel(self):
+        # Diff and format the aligned frames in parallel, and write the output
+        # in order as it becomes available
+        if isinstance(self.highlighter, AnsiHighlighter):
+            highlighterClass = AnsiHighlighter
+        else:
+            highlighterClass = PlainHighlighter
+        for text in self.getPool().imap(diffShard, self.getShards(highlighterClass)):
+            self.highlighter.write(text)
+
+    def getShards(self, highlighterClass):
+        for tag, alo, ahi, blo, bhi in alignFrames(self.a, self.b):
+            if tag == 'equal':
+                if self.suppressCommonLines:
+                    continue
+                ranges = [
+                    (lo, min(lo + maxEqualShardSize, ahi), blo + lo - alo, blo + min(lo + maxEqualShardSize, ahi) - alo)
+                    for lo in xrange(alo, ahi, maxEqualShardSize)
+                ]
+            else:
+                ranges = [(alo, ahi, blo, bhi)]
+            for alo, ahi, blo, bhi in ranges:
+                # Approximate the call number padding of the preceding output
+                aSpace = len(str(self.a.nos[alo - 1])) if alo else 0
+                bSpace = len(str(self.b.nos[blo - 1])) if blo else 0
+                yield self.options, highlighterClass, tag, self.a[alo:ahi], self.b[blo:bhi], aSpace, bSpace
+
+    def dispatch(self, tag, alo, ahi, blo, bhi):
+        if tag == 'replace':
+            self.replace(alo, ahi, blo, bhi)
+        elif tag == 'delete':
+            self.delete(alo, ahi, blo, bhi)
+        elif tag == 'insert':
+            self.insert(alo, ahi, blo, bhi)
+        elif tag == 'equal':
+            self.equal(alo, ahi, blo, bhi)
+        else:
+            raise ValueError, 'unknown tag %s' % (tag,)
 
-    def isjunk(self, call):
-        return call.functionName == 'glGetError' and call.ret in ('GL_NO_ERROR', 0)
+    def isjunk(self, key):
+        functionName, args, ret = pickle.loads(key)
+        return functionName == 'glGetError' and ret in ('GL_NO_ERROR', 0)
 
     def replace(self, alo, ahi, blo, bhi):
         assert alo < ahi and blo < bhi
 
-        a_names = [call.functionName for call in self.a[alo:ahi]]
-        b_names = [call.functionName for call in self.b[blo:bhi]]
+        a_names = [self.a.functionName(i) for i in xrange(alo, ahi)]
+        b_names = [self.b.functionName(i) for i in xrange(blo, bhi)]
 
-        matcher = difflib.SequenceMatcher(None, a_names, b_names)
-        for tag, _alo, _ahi, _blo, _bhi in matcher.get_opcodes():
+        for tag, _alo, _ahi, _blo, _bhi in getOpcodes(a_names, b_names):
             _alo += alo
             _ahi += alo
             _blo += blo
@@ -539,6 +1105,18 @@ def main():
         action="store_true",
         dest="suppressCommonLines", default=False,
         help="do not output common lines")
+    optparser.add_option(
+        '-j', '--jobs', metavar='NUM',
+        type="int", dest="jobs", default=1,
+        help="number of parallel jobs for the python diff tool [default: %default]")
+    optparser.add_option(
+        '--window', metavar='FRAMES',
+        type="int", dest="window", default=0,
+        help="diff incrementally, reading FRAMES frames at a time, for the python diff tool")
+    optparser.add_option(
+        '--cache-dir', metavar='DIR',
+        type="string", dest="cacheDir", default=None,
+        help="cache loaded traces in DIR, for the python diff tool")
     optparser.add_option(
         '-w', '--width', metavar='NUM',
         type="int", dest="width",
@@ -30,11 +30,18 @@ Run as:
 
    apitrace pickle foo.trace | python unpickle.py
 
+or, for faster parsing of large traces:
+
+   apitrace pickle --format=chunked foo.trace | python unpickle.py
+
 '''
 
 
+import array
+import cStringIO
 import itertools
 import optparse
+import struct
 import sys
 import time
 import re
@@ -55,6 +62,11 @@ CALL_FLAG_MARKER_PUSH       = (1 << 9)
 CALL_FLAG_MARKER_POP        = (1 << 10)
 
 
+# Header of each stream format, as written by cli_pickle.cpp
+PICKLE_PROTO = '\x80\x02'
+CHUNKED_MAGIC = 'ATPK'
+
+
 class Pointer(long):
 
     def __str__(self):
@@ -66,6 +78,32 @@ class Pointer(long):
     __repr__ = __str__
 
 
+class Blob(object):
+    '''Data-less proxy for bytearrays, as written by `apitrace pickle
+    --blob-digests`.'''
+
+    __slots__ = ('size', 'digest')
+
+    def __init__(self, size, digest):
+        self.size = size
+        self.digest = digest
+
+    def __reduce__(self):
+        return Blob, (self.size, self.digest)
+
+    def __repr__(self):
+        return 'blob(%u)' % self.size
+
+    def __eq__(self, other):
+        return isinstance(other, Blob) and self.size == other.size and self.digest == other.digest
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.digest)
+
+
 class Visitor:
 
     def __init__(self):
@@ -81,6 +119,7 @@ class Visitor:
         self.dispatch[dict] = self.visitDict
         self.dispatch[bytearray] = self.visitByteArray
         self.dispatch[Pointer] = self.visitPointer
+        self.dispatch[Blob] = self.visitBlob
 
     def visit(self, obj):
         method = self.dispatch.get(obj.__class__, self.visitObj)
@@ -125,6 +164,9 @@ class Visitor:
     def visitPointer(self, obj):
         return self.visitAtom(obj)
 
+    def visitBlob(self, obj):
+        return self.visitAtom(obj)
+
 
 class Dumper(Visitor):
 
@@ -197,7 +239,9 @@ class Rebuilder(Visitor):
         return obj
 
 
-class Call:
+class Call(object):
+
+    __slots__ = ('no', 'functionName', 'args', 'ret', 'flags', '_hash')
 
     def __init__(self, callTuple):
         self.no, self.functionName, self.args, self.ret, self.flags = callTuple
@@ -228,12 +272,98 @@ class Call:
         return self._hash
 
 
+def callKey(call):
+    '''Pickle a call's function name, arguments, and return value into a
+    string, such that equal calls have equal keys.'''
+
+    stream = cStringIO.StringIO()
+    pickler = pickle.Pickler(stream, pickle.HIGHEST_PROTOCOL)
+    # Disable the memo, so that the output depends solely on the values
+    pickler.fast = 1
+    pickler.dump((call.functionName, call.args, call.ret))
+    return stream.getvalue()
+
+
+class CallList(object):
+    '''Compact, columnar sequence of calls.
+
+    Call numbers, function name ids, and flags are kept in typed arrays, while
+    the function name, arguments, and return value of each call are kept
+    pickled (see callKey) until the call is accessed.
+    '''
+
+    callFactory = Call
+
+    def __init__(self, calls = ()):
+        self.nos = array.array('I')
+        self.functionIds = array.array('I')
+        self.flags = array.array('I')
+        self.keys = []
+        self.functionNames = []
+        self._functionIds = {}
+        self.extend(calls)
+
+    def getFunctionId(self, functionName):
+        try:
+            return self._functionIds[functionName]
+        except KeyError:
+            functionId = len(self.functionNames)
+            self.functionNames.append(functionName)
+            self._functionIds[functionName] = functionId
+            return functionId
+
+    def append(self, call):
+        self.nos.append(call.no)
+        self.functionIds.append(self.getFunctionId(call.functionName))
+        self.flags.append(call.flags)
+        self.keys.append(callKey(call))
+
+    def extend(self, calls):
+        if isinstance(calls, CallList):
+            functionIds = map(self.getFunctionId, calls.functionNames)
+            self.nos.extend(calls.nos)
+            self.functionIds.extend(array.array('I', [functionIds[functionId] for functionId in calls.functionIds]))
+            self.flags.extend(calls.flags)
+            self.keys.extend(calls.keys)
+        else:
+            for call in calls:
+                self.append(call)
+
+    def functionName(self, index):
+        return self.functionNames[self.functionIds[index]]
+
+    def __len__(self):
+        return len(self.nos)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            calls = CallList()
+            calls.nos = self.nos[index]
+            calls.functionIds = self.functionIds[index]
+            calls.flags = self.flags[index]
+            calls.keys = self.keys[index]
+            calls.functionNames = list(self.functionNames)
+            calls._functionIds = dict(self._functionIds)
+            return calls
+        functionName, args, ret = pickle.loads(self.keys[index])
+        return self.callFactory((self.nos[index], functionName, args, ret, self.flags[index]))
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+
 class Unpickler:
+    '''Parses both the plain pickle stream (one pickle per call) and the
+    chunked stream (length-prefixed pickled lists of calls), which is read in
+    large blocks and is much faster to decode.'''
 
     callFactory = Call
 
     def __init__(self, stream):
         self.stream = stream
+        self._chunked = None
+        self._callTuples = iter(())
 
     def parse(self):
         while self.parseCall():
@@ -241,7 +371,7 @@ class Unpickler:
 
     def parseCall(self):
         try:
-            callTuple = pickle.load(self.stream)
+            callTuple = self.readCallTuple()
         except EOFError:
             return False
         else:
@@ -253,6 +383,42 @@ class Unpickler:
             else:
                 return True
 
+    def readCallTuple(self):
+        if self._chunked is None:
+            self._chunked = self.readHeader()
+
+        if not self._chunked:
+            return pickle.load(self.stream)
+
+        while True:
+            try:
+                return self._callTuples.next()
+            except StopIteration:
+                self._callTuples = iter(self.readChunk())
+
+    def readHeader(self):
+        header = self.stream.read(len(PICKLE_PROTO))
+        if not header:
+            raise EOFError
+        if header == PICKLE_PROTO:
+            # The protocol opcode is optional, so the rest of the first
+            # pickle can still be loaded as usual.
+            return False
+        header += self.stream.read(len(CHUNKED_MAGIC) - len(header))
+        if header == CHUNKED_MAGIC:
+            return True
+        raise ValueError('unexpected pickle stream header %r' % header)
+
+    def readChunk(self):
+        prefix = self.stream.read(4)
+        if len(prefix) < 4:
+            raise EOFError
+        length, = struct.unpack('<I', prefix)
+        chunk = self.stream.read(length)
+        if len(chunk) < length:
+            raise EOFError
+        return pickle.loads(chunk)
+
     def handleCall(self, call):
         pass
 
@@ -286,7 +452,7 @@ class Counter(Unpickler):
 
 def main():
     optparser = optparse.OptionParser(
-        usage="\n\tapitrace pickle <trace> | %prog [options]")
+        usage="\n\tapitrace pickle [--format=chunked] <trace> | %prog [options]")
     optparser.add_option(
         '-p', '--profile',
         action="store_true", dest="profile", default=False,
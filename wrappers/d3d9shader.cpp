@@ -35,7 +35,7 @@
 #include "d3d9size.hpp"
 
 
-void DumpShader(trace::Writer &writer, const DWORD *tokens)
+void DumpShader(trace::LocalWriter &writer, const DWORD *tokens)
 {
     IDisassemblyBuffer *pDisassembly = NULL;
     HRESULT hr = DisassembleShader(tokens, &pDisassembly);
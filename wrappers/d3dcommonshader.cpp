@@ -31,7 +31,7 @@
 #include "d3dcommonshader.hpp"
 
 
-void DumpShader(trace::Writer &writer, const void *pShaderBytecode, SIZE_T BytecodeLength)
+void DumpShader(trace::LocalWriter &writer, const void *pShaderBytecode, SIZE_T BytecodeLength)
 {
     IDisassemblyBuffer *pDisassembly = NULL;
     HRESULT hr = DisassembleShader(pShaderBytecode, BytecodeLength, &pDisassembly);
@@ -29,8 +29,8 @@
 
 #include <windows.h>
 
-#include "trace_writer.hpp"
+#include "trace_writer_local.hpp"
 
-void DumpShader(trace::Writer &writer, const void *pShaderBytecode, SIZE_T BytecodeLength);
+void DumpShader(trace::LocalWriter &writer, const void *pShaderBytecode, SIZE_T BytecodeLength);
 
 
@@ -354,6 +354,52 @@ class GlTracer(Tracer):
         print '    }'
         print
 
+    # Functions to query the pointer of the mappings being unmapped
+    unmap_function_pointers = {
+        'glUnmapBuffer': ('_glGetBufferPointerv', 'target'),
+        'glUnmapBufferARB': ('_glGetBufferPointervARB', 'target'),
+        'glUnmapBufferOES': ('_glGetBufferPointervOES', 'target'),
+        'glUnmapNamedBuffer': ('_glGetNamedBufferPointerv', 'buffer'),
+        'glUnmapNamedBufferEXT': ('_glGetNamedBufferPointervEXT', 'buffer'),
+    }
+
+    # Functions to query the size of the buffers being mapped whole
+    map_function_sizes = {
+        'glMapBuffer': ('_glGetBufferParameteriv', 'target'),
+        'glMapBufferARB': ('_glGetBufferParameterivARB', 'target'),
+        'glMapBufferOES': ('_glGetBufferParameteriv', 'target'),
+        'glMapNamedBuffer': ('_glGetNamedBufferParameteriv', 'buffer'),
+        'glMapNamedBufferEXT': ('_glGetNamedBufferParameterivEXT', 'buffer'),
+    }
+
+    def mappingShadowEpilog(self, function):
+        # Shadow writable mappings, so that only the modified regions get
+        # traced.  Only mappings with read access can be shadowed, as reading
+        # write-only mappings is undefined, and their contents need not match
+        # the buffer's.  Invalidated and persistent mappings can't be
+        # shadowed either, as their contents are undefined or can change
+        # under our feet.
+        if function.name in self.map_function_sizes:
+            getter, obj = self.map_function_sizes[function.name]
+            print '    if (_result && access != GL_READ_ONLY && trace::isShadowingMappings()) {'
+            print '        GLint _size = 0;'
+            print '        %s(%s, GL_BUFFER_SIZE, &_size);' % (getter, obj)
+            print '        if (access == GL_READ_WRITE) {'
+            print '            trace::shadowMapping(_result, _size > 0 ? _size : 0);'
+            print '        } else {'
+            print '            trace::unshadowMapping(_result, _size > 0 ? _size : 0);'
+            print '        }'
+            print '    }'
+        if function.name in ('glMapBufferRange', 'glMapBufferRangeEXT', 'glMapNamedBufferRange', 'glMapNamedBufferRangeEXT'):
+            print '    if (_result && (access & GL_MAP_WRITE_BIT) && trace::isShadowingMappings()) {'
+            print '        if ((access & GL_MAP_READ_BIT) &&'
+            print '            !(access & (GL_MAP_INVALIDATE_RANGE_BIT | GL_MAP_INVALIDATE_BUFFER_BIT | GL_MAP_PERSISTENT_BIT))) {'
+            print '            trace::shadowMapping(_result, length > 0 ? length : 0);'
+            print '        } else {'
+            print '            trace::unshadowMapping(_result, length > 0 ? length : 0);'
+            print '        }'
+            print '    }'
+
     def shadowBufferProlog(self, function):
         if function.name == 'glBufferData':
             self.shadowBufferMethod('bufferData(size, data)')
@@ -578,7 +624,7 @@ class GlTracer(Tracer):
             print '                flush = flush && flushing_unmap;'
             print '            }'
             print '            if (flush && length > 0) {'
-            self.emit_memcpy('map', 'length')
+            self.emit_memcpy_modified('map', 'length')
             print '            }'
             print '        }'
             print '    }'
@@ -607,7 +653,7 @@ class GlTracer(Tracer):
             print '                _glGetBufferParameteriv(target, GL_BUFFER_SIZE, &length);'
             print '            }'
             print '            if (flush && length > 0) {'
-            self.emit_memcpy('map', 'length')
+            self.emit_memcpy_modified('map', 'length')
             self.shadowBufferMethod('bufferSubData(offset, length, map)')
             print '            }'
             print '        }'
@@ -622,7 +668,7 @@ class GlTracer(Tracer):
             print '        GLint length = 0;'
             print '        _glGetNamedBufferParameteriv(buffer, GL_BUFFER_MAP_LENGTH, &length);'
             print '        if (map && length > 0) {'
-            self.emit_memcpy('map', 'length')
+            self.emit_memcpy_modified('map', 'length')
             print '        }'
             print '    }'
         if function.name == 'glUnmapNamedBufferEXT':
@@ -635,38 +681,45 @@ class GlTracer(Tracer):
             print '        GLint length = 0;'
             print '        _glGetNamedBufferParameterivEXT(buffer, GL_BUFFER_MAP_LENGTH, &length);'
             print '        if (map && length > 0) {'
-            self.emit_memcpy('map', 'length')
+            self.emit_memcpy_modified('map', 'length')
             print '        }'
             print '    }'
+        if function.name in self.unmap_function_pointers:
+            getter, obj = self.unmap_function_pointers[function.name]
+            print '    if (trace::isShadowingMappings()) {'
+            print '        GLvoid *_map = NULL;'
+            print '        %s(%s, GL_BUFFER_MAP_POINTER, &_map);' % (getter, obj)
+            print '        trace::unshadowMapping(_map);'
+            print '    }'
         if function.name == 'glFlushMappedBufferRange':
             print '    GLvoid *map = NULL;'
             print '    _glGetBufferPointerv(target, GL_BUFFER_MAP_POINTER, &map);'
             print '    if (map && length > 0) {'
-            self.emit_memcpy('(const char *)map + offset', 'length')
+            self.emit_memcpy_modified('(const char *)map + offset', 'length')
             print '    }'
         if function.name == 'glFlushMappedBufferRangeEXT':
             print '    GLvoid *map = NULL;'
             print '    _glGetBufferPointervOES(target, GL_BUFFER_MAP_POINTER_OES, &map);'
             print '    if (map && length > 0) {'
-            self.emit_memcpy('(const char *)map + offset', 'length')
+            self.emit_memcpy_modified('(const char *)map + offset', 'length')
             print '    }'
         if function.name == 'glFlushMappedBufferRangeAPPLE':
             print '    GLvoid *map = NULL;'
             print '    _glGetBufferPointerv(target, GL_BUFFER_MAP_POINTER, &map);'
             print '    if (map && size > 0) {'
-            self.emit_memcpy('(const char *)map + offset', 'size')
+            self.emit_memcpy_modified('(const char *)map + offset', 'size')
             print '    }'
         if function.name == 'glFlushMappedNamedBufferRange':
             print '    GLvoid *map = NULL;'
             print '    _glGetNamedBufferPointerv(buffer, GL_BUFFER_MAP_POINTER, &map);'
             print '    if (map && length > 0) {'
-            self.emit_memcpy('(const char *)map + offset', 'length')
+            self.emit_memcpy_modified('(const char *)map + offset', 'length')
             print '    }'
         if function.name == 'glFlushMappedNamedBufferRangeEXT':
             print '    GLvoid *map = NULL;'
             print '    _glGetNamedBufferPointervEXT(buffer, GL_BUFFER_MAP_POINTER, &map);'
             print '    if (map && length > 0) {'
-            self.emit_memcpy('(const char *)map + offset', 'length')
+            self.emit_memcpy_modified('(const char *)map + offset', 'length')
             print '    }'
 
         # FIXME: We don't support coherent/pinned memory mappings
@@ -747,6 +800,8 @@ class GlTracer(Tracer):
 
         Tracer.traceFunctionImplBody(self, function)
 
+        self.mappingShadowEpilog(function)
+
     # These entrypoints are only expected to be implemented by tools;
     # drivers will probably not implement them.
     marker_functions = [
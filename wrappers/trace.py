@@ -959,6 +959,9 @@ class Tracer:
     
     def emit_memcpy(self, ptr, size):
         print '    trace::fakeMemcpy(%s, %s);' % (ptr, size)
+
+    def emit_memcpy_modified(self, ptr, size):
+        print '    trace::fakeMemcpyModified(%s, %s);' % (ptr, size)
     
     def fake_call(self, function, args):
         print '            unsigned _fake_call = trace::localWriter.beginEnter(&_%s_sig, true);' % (function.name,)